@@ -0,0 +1,252 @@
+"""Benchmark of the analysis stages on synthetic sites.
+
+Each stage is run on its own process for every site in a grid of N, S, and G, and the wall time and the
+peak memory of the process are written to a JSON file, which can be compared across commits.
+Example, with the default grid:
+    python ssnt_mete_benchmark.py --out ./out_files/benchmark.json
+or only the SSNT models on small sites:
+    python ssnt_mete_benchmark.py --N 1000 10000 --S 50 --G 10 --models ssnt_0 ssnt_1
+
+"""
+from __future__ import division
+import matplotlib
+matplotlib.use('Agg')
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import resource
+import argparse
+import subprocess
+import traceback
+import multiprocessing
+import numpy as np
+import ssnt_mete_comparison as smc
+
+def get_letter_code(i, width = 4):
+    """Lowercase letters coding for integer i, e.g. 'aaab' for 1, since genus names cannot contain digits."""
+    return ''.join([chr(97 + (i // 26 ** k) % 26) for k in reversed(xrange(width))])
+
+def make_synthetic_site(N, S, G, seed = 0, site = 'synthetic'):
+    """Synthetic site in the format returned by smc.clean_data_agsne().
+
+    Inputs:
+    N, S, G - number of individuals, species, and genera, with G <= S <= N
+    seed - seed of the random numbers
+    site - name of the site
+
+    Output:
+    A structured array with columns 'site', 'sp', 'dbh', and 'genus'. Species are assigned to genera in turn,
+    so that every genus has at least one species. Every species has at least one individual, and the
+    remaining individuals are assigned to species with weights drawn from a log-series. Diameters
+    (in mm) are drawn from a Pareto distribution above 10.
+
+    """
+    if not G <= S <= N: raise ValueError('A synthetic site requires G <= S <= N.')
+    rand_state = np.random.RandomState(seed)
+    genus_names = ['G' + get_letter_code(i) for i in xrange(G)]
+    sp_names = np.array([genus_names[i % G] + ' sp' + str(i) for i in xrange(S)])
+    sp_weights = rand_state.logseries(0.999, S).astype(float)
+    sp_ind = np.concatenate((np.arange(S), rand_state.choice(S, N - S, p = sp_weights / np.sum(sp_weights))))
+    sp_ind = sp_ind[rand_state.permutation(N)]
+
+    out = np.zeros(N, dtype = [('site', 'S15'), ('sp', 'S40'), ('dbh', 'f8'), ('genus', 'S20')])
+    out['site'] = site
+    out['sp'] = sp_names[sp_ind]
+    out['dbh'] = 10 * (1 + rand_state.pareto(2, N))
+    out['genus'] = np.array(genus_names)[sp_ind % G]
+    return out
+
+def write_synthetic_dataset(dat_clean, dat_name, in_dir):
+    """Store a synthetic site as the cache of smc.ingest_raw_data(), so that it can be read with smc.get_site_data().
+
+    An empty placeholder is written in place of the raw csv file, as the cache is only checked against
+    the size and modification time of the latter (and smc.analysis_version).
+
+    """
+    src_path = in_dir + dat_name + '.csv'
+    if not os.path.isdir(in_dir): os.makedirs(in_dir)
+    open(src_path, 'w').close()
+    smc.write_data_cache(dat_name, in_dir + 'cache/', dat_clean[np.argsort(dat_clean['sp'], kind = 'mergesort')],
+                         [[str(dat_clean['site'][0]), 0, len(dat_clean)]], os.stat(src_path))
+
+def get_stage_list(model_list = ('ssnt_0', 'ssnt_1', 'asne', 'agsne'), pattern_list = ('SAD', 'ISD', 'SDR')):
+    """List of the stages to time, each as a tuple (stage, pattern, model), with None for elements that do not apply.
+
+    Stages are 'get_GSNE', 'fit' (with model 'beta_untruncated', 'beta_precise' or 'agsne'), 'lik'
+    (get_lik_sp_abd_dbh_four_models), 'evaluate_site' (all models and patterns at once), 'obs_pred',
+    and 'bootstrap' (one iteration). The obs_pred stage of the SAD is the same for the two SSNT models,
+    and is only listed under 'ssnt_0'.
+
+    """
+    fit_list = []
+    if 'ssnt_0' in model_list or 'ssnt_1' in model_list: fit_list.append('beta_untruncated')
+    if 'asne' in model_list: fit_list.append('beta_precise')
+    if 'agsne' in model_list: fit_list.append('agsne')
+    stage_list = [('get_GSNE', None, None)] + [('fit', None, fit) for fit in fit_list]
+    stage_list += [('lik', None, None), ('evaluate_site', None, None)]
+    for stage in ['obs_pred', 'bootstrap']:
+        for pattern in pattern_list:
+            for model in model_list:
+                if stage == 'obs_pred' and pattern == 'SAD' and model == 'ssnt_1' and 'ssnt_0' in model_list: continue
+                stage_list.append((stage, pattern, model))
+    return stage_list
+
+def fit_pars(model, G, S, N, E):
+    """Fit the parameters needed by model ('ssnt_0', 'ssnt_1', 'asne', 'agsne', or None for all)."""
+    if model in [None, 'ssnt_0', 'ssnt_1']: smc.get_beta_cached(S, N, version = 'untruncated')
+    if model in [None, 'asne']: smc.get_beta_cached(S, N)
+    if model in [None, 'agsne']: smc.get_agsne_pars(G, S, N, E)
+
+def run_obs_pred(dat_clean, dat_name, pattern, model, out_dir):
+    """Write the observed and predicted values of a pattern for a model with the get_obs_pred_* functions."""
+    if pattern == 'SAD':
+        smc.get_obs_pred_sad(dat_clean, dat_name, 'ssnt' if model in ['ssnt_0', 'ssnt_1'] else model, out_dir = out_dir)
+    elif pattern == 'ISD': smc.get_obs_pred_isd(dat_clean, dat_name, model, out_dir = out_dir)
+    else: smc.get_obs_pred_sdr(dat_clean, dat_name, model, out_dir = out_dir)
+
+def setup_stage(stage, dat_name, site, in_dir, out_dir):
+    """Prepare a stage on a site, returning a function without argument that runs it.
+
+    The setup, which is not timed, reads the site and fits the parameters that the stage does not
+    itself fit (in memory only, as the on-disk parameter cache is disabled). For the bootstrap, it also
+    writes the observed and predicted values to out_dir.
+
+    """
+    stage_name, pattern, model = stage
+    smc.par_cache_dir = None
+    smc._par_cache.clear()
+    dat_clean = smc.get_site_data(dat_name, site, in_dir = in_dir)
+    G, S, N, E = smc.get_GSNE(dat_clean)
+    if stage_name == 'get_GSNE':
+        return lambda: smc.get_GSNE(dat_clean)
+    elif stage_name == 'fit':
+        if model == 'agsne': return lambda: smc.get_agsne_pars(G, S, N, E)
+        else: return lambda: smc.get_beta_cached(S, N, version = model.split('_')[1])
+    fit_pars(model, G, S, N, E)
+    if stage_name == 'lik':
+        return lambda: smc.get_lik_sp_abd_dbh_four_models(dat_clean, dat_name, out_dir = out_dir)
+    elif stage_name == 'evaluate_site':
+        return lambda: smc.evaluate_site(dat_clean, dataset_name = dat_name, out_dir = out_dir)
+    elif stage_name == 'obs_pred':
+        return lambda: run_obs_pred(dat_clean, dat_name, pattern, model, out_dir)
+    run_obs_pred(dat_clean, dat_name, pattern, model, out_dir)
+    bootstrap_func = {'SAD': smc.bootstrap_SAD, 'ISD': smc.bootstrap_ISD, 'SDR': smc.bootstrap_SDR}[pattern]
+    options = {'pool': None} if pattern == 'ISD' else {}
+    return lambda: bootstrap_func([dat_name, site], model, in_dir = in_dir, out_dir = out_dir, Niter = 1, **options)
+
+def get_peak_rss_mb():
+    """Peak resident memory of the current process in MB (ru_maxrss is in bytes on OS X, and in kB elsewhere)."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+
+def _stage_worker(conn, stage, dat_name, site, in_dir, out_dir):
+    """Run one stage in a child process of time_stage(), sending the results through conn."""
+    try:
+        run_stage = setup_stage(stage, dat_name, site, in_dir, out_dir)
+        setup_rss = get_peak_rss_mb()
+        start = time.time()
+        run_stage()
+        smc.get_result_sink().flush()
+        seconds = time.time() - start
+        conn.send({'seconds': seconds, 'setup_rss_mb': setup_rss, 'peak_rss_mb': get_peak_rss_mb(), 'error': None})
+    except Exception:
+        conn.send({'seconds': None, 'setup_rss_mb': None, 'peak_rss_mb': None, 'error': traceback.format_exc()})
+    conn.close()
+
+def time_stage(stage, dat_name, site, in_dir, timeout = None):
+    """Time one stage on a site in a fresh process, so that the peak memory is that of the stage alone.
+
+    Inputs:
+    stage - tuple (stage, pattern, model), see get_stage_list()
+    dat_name, site - the synthetic site, written by write_synthetic_dataset()
+    in_dir - directory of the synthetic data; the output of the stage is written to a temporary
+        directory within it, and removed afterwards
+    timeout - maximal time in seconds for the stage (including setup), or None for no limit
+
+    Output:
+    A dict with 'seconds' (wall time of the stage), 'setup_rss_mb' and 'peak_rss_mb' (peak resident memory
+    of the process before and after the stage), and 'error' (None, 'timeout', or the traceback of the failure).
+
+    """
+    out_dir = tempfile.mkdtemp(dir = in_dir) + '/'
+    parent_conn, child_conn = multiprocessing.Pipe(duplex = False)
+    worker = multiprocessing.Process(target = _stage_worker, args = (child_conn, stage, dat_name, site, in_dir, out_dir))
+    worker.start()
+    child_conn.close()
+    try:
+        if parent_conn.poll(timeout): result = parent_conn.recv()
+        else: result = {'seconds': None, 'setup_rss_mb': None, 'peak_rss_mb': None, 'error': 'timeout'}
+    except EOFError:
+        result = {'seconds': None, 'setup_rss_mb': None, 'peak_rss_mb': None, 'error': 'worker exited without result'}
+    finally:
+        worker.terminate()
+        worker.join()
+        shutil.rmtree(out_dir, ignore_errors = True)
+    return result
+
+def get_commit():
+    """Current git commit of the code, or None if it cannot be found."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = devnull,
+                                           cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+def run_benchmark(N_list, S_list, G_list, stage_list, repeat = 1, seed = 0, timeout = None, work_dir = None):
+    """Time the stages on a synthetic site for each combination of N, S, and G (skipping those without G <= S <= N).
+
+    Output:
+    A dict with the commit, the environment, and 'results', a list with one dict for each site, stage and
+    repetition, with keys 'N', 'S', 'G', 'seed', 'stage', 'pattern', 'model', 'repeat', and those from time_stage().
+
+    """
+    out = {'commit': get_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+           'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': multiprocessing.cpu_count(),
+           'results': []}
+    tmp_dir = tempfile.mkdtemp(dir = work_dir)
+    try:
+        in_dir = tmp_dir + '/data/'
+        for N in N_list:
+            for S in S_list:
+                for G in G_list:
+                    if not G <= S <= N: continue
+                    dat_name = 'synthetic_N' + str(N) + '_S' + str(S) + '_G' + str(G)
+                    write_synthetic_dataset(make_synthetic_site(N, S, G, seed = seed), dat_name, in_dir)
+                    for stage in stage_list:
+                        for i in xrange(repeat):
+                            result = time_stage(stage, dat_name, 'synthetic', in_dir, timeout = timeout)
+                            result.update({'N': N, 'S': S, 'G': G, 'seed': seed, 'stage': stage[0],
+                                           'pattern': stage[1], 'model': stage[2], 'repeat': i})
+                            out['results'].append(result)
+                            print dat_name, ' '.join([str(x) for x in stage if x is not None]), \
+                                  result['seconds'] if result['error'] is None else 'failed', result['peak_rss_mb']
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+    return out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark of the analysis stages on synthetic sites.')
+    parser.add_argument('--N', type = int, nargs = '+', default = [1000, 10000, 100000, 1000000])
+    parser.add_argument('--S', type = int, nargs = '+', default = [50, 300])
+    parser.add_argument('--G', type = int, nargs = '+', default = [10, 100])
+    parser.add_argument('--models', nargs = '+', default = ['ssnt_0', 'ssnt_1', 'asne', 'agsne'])
+    parser.add_argument('--patterns', nargs = '+', default = ['SAD', 'ISD', 'SDR'])
+    parser.add_argument('--stages', nargs = '+', default = None,
+                        help = 'only run these stages (get_GSNE, fit, lik, evaluate_site, obs_pred, bootstrap)')
+    parser.add_argument('--repeat', type = int, default = 1)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--timeout', type = float, default = None, help = 'maximal time in seconds for each stage')
+    parser.add_argument('--out', default = './out_files/benchmark.json')
+    args = parser.parse_args()
+
+    stage_list = get_stage_list(args.models, args.patterns)
+    if args.stages is not None: stage_list = [stage for stage in stage_list if stage[0] in args.stages]
+    out_dir = os.path.dirname(os.path.abspath(args.out))
+    if not os.path.isdir(out_dir): os.makedirs(out_dir)
+    results = run_benchmark(args.N, args.S, args.G, stage_list, repeat = args.repeat, seed = args.seed,
+                            timeout = args.timeout)
+    smc.write_file_atomic(args.out, json.dumps(results, indent = 1, sort_keys = True))
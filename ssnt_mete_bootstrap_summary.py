@@ -0,0 +1,150 @@
+"""Vectorized summaries of the bootstrap results.
+
+A bootstrap file (e.g. SAD_bootstrap_asne_rsquare.txt, see ssnt_mete_comparison.merge_bootstrap_units()) has one
+row per site with the dataset, the site, the observed statistic, and the statistics of the bootstrap samples,
+of which some sites can have fewer. Here the file is loaded as a 2-D float matrix padded with nan, from which the
+quantiles of the observed statistics, their confidence intervals, and the comparisons between models are
+computed for all sites at once. The summaries are exported to a compact table, from which the figures can
+be drawn again without reading the samples.
+
+"""
+from __future__ import division
+import numpy as np
+from scipy import stats
+
+summary_names = ['dataset', 'site', 'orig', 'num_samples', 'quantile', 'quantile_lower', 'quantile_upper',
+                 'sample_lower', 'sample_median', 'sample_upper']
+
+def load_bootstrap_matrix(input_filename, Niter = None):
+    """Load a bootstrap file as a matrix.
+
+    Inputs:
+    input_filename - bootstrap file, with rows dataset, site, observed statistic, sampled statistics
+    Niter - if not None, only the first Niter samples are kept, and the matrix has Niter columns
+
+    Output:
+    dataset, site - arrays of strings, one value per row
+    orig - array of the observed statistics
+    samples - 2-D array with the sampled statistics of each row, padded with nan
+
+    """
+    with open(input_filename) as f:
+        rows = [line.rstrip('\r\n').split(',', 3) for line in f if line.strip()]
+    values = [np.array(row[3].split(','), dtype = float) if len(row) > 3 else np.zeros(0) for row in rows]
+    if Niter is not None: values = [x[:Niter] for x in values]
+    lengths = np.array([len(x) for x in values], dtype = int)
+    num_col = Niter if Niter is not None else max([0] + list(lengths))
+    samples = np.empty((len(rows), num_col))
+    samples.fill(np.nan)
+    if rows: samples[np.arange(num_col) < lengths[:, None]] = np.concatenate(values)
+    dataset = np.array([row[0] for row in rows], dtype = str)
+    site = np.array([row[1] for row in rows], dtype = str)
+    orig = np.array([float(row[2]) for row in rows])
+    return dataset, site, orig, samples
+
+def from_structured(dat_file):
+    """The output of load_bootstrap_matrix() from the structured array of
+
+    ssnt_mete_comparison.import_bootstrap_file_incomp() or import_bootstrap_store().
+
+    """
+    names = dat_file.dtype.names
+    if len(names) > 3: samples = np.column_stack([np.asarray(dat_file[name], dtype = float) for name in names[3:]])
+    else: samples = np.zeros((len(dat_file), 0))
+    return dat_file['dataset'], dat_file['site'], np.asarray(dat_file['orig'], dtype = float), samples
+
+def get_quantile_counts(orig, samples, dat_type = 'r2'):
+    """Number of samples closer to the prediction than the observed statistic in each row, and number of samples.
+
+    For R^2 (dat_type 'r2') these are the samples with a lower statistic, and for the others (e.g. 'ks')
+    those with a larger one. Missing samples (nan) are not counted.
+
+    """
+    with np.errstate(invalid = 'ignore'):
+        if dat_type == 'r2': num_closer = np.sum(samples < orig[:, None], axis = 1)
+        else: num_closer = np.sum(samples > orig[:, None], axis = 1)
+    return num_closer, np.sum(~np.isnan(samples), axis = 1)
+
+def get_quantiles(orig, samples, dat_type = 'r2'):
+    """Quantile of the observed statistic in each row (see get_quantile_counts()), nan for rows without samples."""
+    num_closer, num_samples = get_quantile_counts(orig, samples, dat_type = dat_type)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return num_closer / num_samples
+
+def get_quantile_ci(num_closer, num_samples, ci_level = 0.95):
+    """Clopper-Pearson confidence interval of the quantiles with the counts of get_quantile_counts(), as (lower, upper)."""
+    num_closer, num_samples = np.asarray(num_closer, dtype = float), np.asarray(num_samples, dtype = float)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        lower = np.where(num_closer > 0, stats.beta.ppf((1 - ci_level) / 2, num_closer, num_samples - num_closer + 1), 0)
+        upper = np.where(num_closer < num_samples, stats.beta.ppf(1 - (1 - ci_level) / 2, num_closer + 1, num_samples - num_closer), 1)
+    missing = num_samples == 0
+    lower[missing], upper[missing] = np.nan, np.nan
+    return lower, upper
+
+def get_sample_interval(samples, ci_level = 0.95):
+    """Lower percentile, median, and upper percentile (at (1 - ci_level) / 2 and (1 + ci_level) / 2) of the samples in each row."""
+    out = np.empty((3, samples.shape[0]))
+    out.fill(np.nan)
+    has_samples = np.any(~np.isnan(samples), axis = 1)
+    if np.any(has_samples):
+        out[:, has_samples] = np.nanpercentile(samples[has_samples], [50 * (1 - ci_level), 50, 50 * (1 + ci_level)], axis = 1)
+    return out[0], out[1], out[2]
+
+def summarize_bootstrap(dataset, site, orig, samples, dat_type = 'r2', ci_level = 0.95):
+    """Summary of the bootstrap of each site, as a structured array with the fields in summary_names.
+
+    num_samples is the number of samples, quantile the quantile of the observed statistic (see get_quantiles())
+    with its confidence interval quantile_lower and quantile_upper, and sample_lower, sample_median, and
+    sample_upper the percentiles of the sampled statistics (see get_sample_interval()).
+
+    """
+    num_closer, num_samples = get_quantile_counts(orig, samples, dat_type = dat_type)
+    summary = np.zeros(len(orig), dtype = {'names': summary_names, 'formats': ['S15', 'S15'] + ['f8'] * 8})
+    summary['dataset'], summary['site'], summary['orig'], summary['num_samples'] = dataset, site, orig, num_samples
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        summary['quantile'] = num_closer / num_samples
+    summary['quantile_lower'], summary['quantile_upper'] = get_quantile_ci(num_closer, num_samples, ci_level = ci_level)
+    summary['sample_lower'], summary['sample_median'], summary['sample_upper'] = get_sample_interval(samples, ci_level = ci_level)
+    return summary
+
+def count_zero_quantiles(quantiles):
+    """Number of sites where no sample is closer to the prediction than the observed statistic, and number of sites."""
+    quantiles = np.asarray(quantiles, dtype = float)
+    quantiles = quantiles[~np.isnan(quantiles)]
+    return int(np.sum(quantiles == 0)), len(quantiles)
+
+def compare_models(summary_dict):
+    """Compare the quantiles of several models on the sites that all of them have.
+
+    Inputs:
+    summary_dict - dictionary mapping each model to the output of summarize_bootstrap() for the same pattern and statistic
+
+    Output:
+    model_list - the models, sorted
+    site_keys - sorted list of (dataset, site) of the common sites
+    quantiles - 2-D array with the quantile of each site (row) for each model (column)
+    frac_higher - 2-D array with the proportion of sites where the quantile of model i is higher than that of model j
+
+    """
+    model_list = sorted(summary_dict)
+    site_keys = sorted(set.intersection(*[set(zip(summary_dict[model]['dataset'], summary_dict[model]['site'])) 
+                                          for model in model_list]))
+    quantiles = np.zeros((len(site_keys), len(model_list)))
+    for j, model in enumerate(model_list):
+        summary = summary_dict[model]
+        quantile_lookup = dict(zip(zip(summary['dataset'], summary['site']), summary['quantile']))
+        quantiles[:, j] = [quantile_lookup[key] for key in site_keys]
+    frac_higher = np.mean(quantiles[:, :, None] > quantiles[:, None, :], axis = 0) if site_keys else \
+        np.zeros((len(model_list), len(model_list)))
+    return model_list, site_keys, quantiles, frac_higher
+
+def format_summary_table(summary):
+    """The output of summarize_bootstrap() as the text of a csv file with a header, read by import_summary_table()."""
+    rows = [','.join(summary_names)]
+    for row in summary:
+        rows.append(','.join([str(row['dataset']), str(row['site'])] + [repr(float(row[name])) for name in summary_names[2:]]))
+    return '\n'.join(rows) + '\n'
+
+def import_summary_table(file_path):
+    """Read a table from format_summary_table() into the same structured array as summarize_bootstrap()."""
+    return np.genfromtxt(file_path, delimiter = ',', names = True, dtype = ['S15', 'S15'] + ['f8'] * 8)
@@ -2,69 +2,23 @@ from __future__ import division
 import matplotlib
 matplotlib.use('Agg')
 
-import matplotlib.pyplot as plt
 import ssnt_mete_comparison as smc
-import working_functions as wk
-import mete_distributions as medis
-import numpy as np
-import multiprocessing
 
 dat_list = ['ACA', 'BCI', 'BVSF', 'CSIRO', 'FERP', 'Lahei', 'LaSelva', 'NC', 'Oosting', 'Serimbu', 
             'WesternGhats', 'Cocoli', 'Luquillo', 'Sherman', 'Shirakami']
-
-# Obtain predicted-observed values for the three patterns from the four models 
-dat_list_keep = []
-dat_site_list = []
 model_list = ['ssnt_0', 'ssnt_1', 'asne', 'agsne']
-for dat_name in dat_list:
-    dat = wk.import_raw_data('./data/' + dat_name + '.csv')
-    for site in np.unique(dat['site']):
-        dat_site = dat[dat['site'] == site]
-        dat_clean = smc.clean_data_agsne(dat_site)
-        if dat_clean is not None:
-            dat_list_keep.append(dat_name)
-            dat_site_list.append([dat_name, site])
-            smc.get_lik_sp_abd_dbh_four_models(dat_clean, dat_name)
-           
-            for model in model_list:
-                if model is 'ssnt_0': smc.get_obs_pred_sad(dat_clean, dat_name, 'ssnt')
-                elif model in ['asne', 'agsne']: smc.get_obs_pred_sad(dat_clean, dat_name, model)
-                smc.get_obs_pred_isd(dat_clean, dat_name, model)
-                smc.get_obs_pred_sdr(dat_clean, dat_name, model)
 
-# Obtain and plot the log-likelihood comparisons (Fig.1)
-smc.plot_likelihood_comp()
-# Plot the predicted versus observed values (Fig. 2)
-smc.plot_obs_pred_four_models(dat_list_keep)
-# Plot the R^2 comparisons (Fig. 3)
-smc.plot_r2_comp(dat_site_list)
+# Sites are cleaned once and cached in ./data/cache/; sites that fail the cleaning are not in the cache
+dat_site_sizes = []
+for dat_name in dat_list:
+    for site, offset, length in smc.ingest_raw_data(dat_name):
+        dat_site_sizes.append([dat_name, site, length])
+dat_site_list = [[dat_name, site] for dat_name, site, N in dat_site_sizes]
+dat_list_keep = [dat_name for dat_name, site in dat_site_list]
 
-# Boostrap analyses
+# Obtain the predicted-observed values, the log-likelihoods and the bootstrap analyses, and plot them (Figs. 1 - 3, B1 - B4), 
+# as one graph of tasks run on smc.core_budget processes (see smc.build_task_graph() and smc.run_task_graph())
 # Caution: the bootstrap analyses can take days, depending on the size of the data sets
-for model in model_list:
-    def model_boot_sad(name_site_combo):
-        smc.bootstrap_SAD(name_site_combo, model, Niter = 500)
-    pool = multiprocessing.Pool(8)  # Assuming that there are 8 cores
-    pool.map(model_boot_sad, dat_site_list)
-    pool.close()
-    pool.join()
-
-for model in model_list:
-    def model_boot_isd(name_site_combo):
-        smc.bootstrap_ISD(name_site_combo, model, Niter = 500)
-    pool = multiprocessing.Pool(8)  # Assuming that there are 8 cores
-    pool.map(model_boot_isd, dat_site_list)
-    pool.close()
-    pool.join()
-
-for model in model_list:
-    def model_boot_sdr(name_site_combo):
-        smc.bootstrap_SDR(name_site_combo, model, Niter = 500)
-    pool = multiprocessing.Pool(8)  # Assuming that there are 8 cores
-    pool.map(model_boot_sdr, dat_site_list)
-    pool.close()
-    pool.join()
-
-# Plot results from bootstrap analysis for four models (Figs B1 - B4)
-for model in model_list:
-    smc.plot_bootstrap(dat_list, model)
+task_graph = smc.build_task_graph(dat_site_sizes, model_list = model_list)
+options = {'Niter': 500, 'dat_site_list': dat_site_list, 'dat_list': dat_list_keep, 'model_list': model_list}
+smc.run_task_graph(task_graph, options)
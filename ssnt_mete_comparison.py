@@ -4,17 +4,66 @@ matplotlib.use('Agg')
 import os
 import matplotlib.pyplot as plt
 import csv
+import json
+import hashlib
+import tempfile
+import fcntl
+import io
+import mmap
+import time
+import heapq
+import glob
+import socket
+import atexit
+import Queue
+import traceback
+import threading
+from collections import OrderedDict
 import numpy as np
-from numpy.lib.recfunctions import append_fields
-from scipy import stats, integrate
+from scipy import stats, special, optimize
 import working_functions as wk
 import mete
 import mete_distributions
 import mete_agsne as agsne
 import macroecotools as mtools
 import macroeco_distributions as md
+import ssnt_mete_bootstrap_summary as boot_summary
 import multiprocessing
 
+# Cache of fitted model parameters, keyed by model and state variables. 
+# The in-process layer keeps the par_cache_size most recently used entries; 
+# the on-disk layer is shared by all processes and can be disabled by setting par_cache_dir to None.
+par_cache_size = 256
+par_cache_dir = './out_files/par_cache/'
+_par_cache = OrderedDict()
+
+# Power of diameter with constant growth in the two versions of SSNT
+ssnt_alpha = {'ssnt_0': 1, 'ssnt_1': 2/3}
+
+# Total number of cores that the analyses are allowed to use, shared by all worker pools.
+core_budget = multiprocessing.cpu_count()
+_worker_pool = None
+
+# Destination of the rows of text output (see get_result_sink()), created on first use in each process.
+_result_sink = None
+
+# Seed of the random streams of the bootstrap analyses (see seed_bootstrap_block()), or None for unseeded runs.
+bootstrap_seed = 0
+
+# Version of the analyses, which is part of the provenance hash of each site-level output (see get_input_hash()) 
+# and of the cache of cleaned data (see ingest_raw_data()). Increase it whenever a change to the code or to its 
+# parameters (including the cleaning) changes the results, so that they are recomputed.
+analysis_version = 1
+
+# Optional instrumentation of the analyses (see profile_stage() and profile_count()), off unless profile_dir 
+# is set to a directory. Each process aggregates its timers and counters by stage and by the tags below, 
+# and writes them to its own file in profile_dir; merge_profile() combines them into one trace.
+profile_dir = None
+profile_tag_names = ['dataset', 'site', 'model', 'pattern']
+_profile_records = {}
+_profile_tags = {}
+_profile_pid = None
+
 class ssnt_isd_bounded():
     """The individual-size distribution predicted by SSNT.
     
@@ -37,31 +86,293 @@ class ssnt_isd_bounded():
         self.a = 1 # lower bound
         
     def pdf(self, x):
-        if x < self.a: return 0
-        else: return self.par * self.alpha * np.exp(-self.par * (x ** self.alpha - 1)) * (x ** (self.alpha - 1))
+        x = np.asarray(x, dtype = float)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            out = np.where(x < self.a, 0, self.par * self.alpha * np.exp(-self.par * (x ** self.alpha - 1)) * (x ** (self.alpha - 1)))
+        return out[()]
+    
+    def logpdf(self, x):
+        x = np.asarray(x, dtype = float)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            out = np.where(x < self.a, -np.inf, np.log(self.par * self.alpha) - self.par * (x ** self.alpha - 1) + 
+                           (self.alpha - 1) * np.log(x))
+        return out[()]
     
     def cdf(self, x): # cdf of D is equal to cdf of D^alpha
-        if x < self.a: return 0
-        else: return 1 - np.exp(-self.par * (x ** self.alpha - 1))
+        x = np.asarray(x, dtype = float)
+        with np.errstate(invalid = 'ignore'):
+            out = np.where(x < self.a, 0, -np.expm1(-self.par * (x ** self.alpha - 1)))
+        return out[()]
+    
+    def logcdf(self, x):
+        x = np.asarray(x, dtype = float)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            out = np.where(x < self.a, -np.inf, np.log(-np.expm1(-self.par * (x ** self.alpha - 1))))
+        return out[()]
     
     def ppf(self, q):
-        return (1 - np.log(1 - q) / self.par) ** (1 / self.alpha)
+        q = np.asarray(q, dtype = float)
+        return ((1 - np.log1p(-q) / self.par) ** (1 / self.alpha))[()]
     
     def rvs(self, size):
         rand_list = stats.uniform.rvs(size = size)
-        out = np.array([self.ppf(x) for x in rand_list])
-        return out
+        return self.ppf(rand_list)
+    
+    def moment(self, k):
+        """k-th raw moment of D in closed form.
+        
+        D^alpha - 1 is exponential with rate par, so E[D^k] = exp(par) * par^(-s) * Gamma(s + 1, par)
+        with s = k / alpha and Gamma(., .) the upper incomplete gamma function.
+        
+        """
+        s = k / self.alpha
+        log_mom = self.par - s * np.log(self.par) + special.gammaln(s + 1) + np.log(special.gammaincc(s + 1, self.par))
+        return np.exp(log_mom)
     
     def expected(self):  # Note that this is the expected value of D
-        ans = integrate.quad(lambda x: x * self.pdf(x), self.a, np.inf)[0]
-        return ans
+        return self.moment(1)
     
     def expected_square(self):
-        ans = integrate.quad(lambda x: x ** 2 * self.pdf(x), self.a, np.inf)[0]
-        return ans        
+        return self.moment(2)
+
+class site_index():
+    """Species and genus grouping of the individuals in a single site.
+    
+    Built once from the output of clean_data_agsne(), so that per-species 
+    quantities can be obtained with one pass over the site instead of 
+    masking the whole site for each species. Species are in the same 
+    (sorted) order as np.unique(raw_data_site['sp']).
+    
+    Attributes:
+    sp_names, genus_names - unique species and genus names
+    sp_codes, genus_codes - integer species / genus code of each individual
+    sp_counts - abundance n of each species
+    sp_genus - genus code of each species
+    genus_sp_counts - number of species within each genus
+    sp_m - number of species within the genus of each species
+    order - indices that sort the individuals by species
+    offsets - start of each species in the sorted individuals
+    
+    """
+    def __init__(self, raw_data_site):
+        self.sp_names, sp_first, self.sp_codes = np.unique(raw_data_site['sp'], return_index = True, return_inverse = True)
+        self.genus_names, self.genus_codes = np.unique(raw_data_site['genus'], return_inverse = True)
+        self.S, self.G, self.N = len(self.sp_names), len(self.genus_names), len(raw_data_site)
+        self.sp_counts = np.bincount(self.sp_codes, minlength = self.S)
+        self.sp_genus = self.genus_codes[sp_first]
+        self.genus_sp_counts = np.bincount(self.sp_genus, minlength = self.G)
+        self.sp_m = self.genus_sp_counts[self.sp_genus]
+        self.order = np.argsort(self.sp_codes, kind = 'mergesort')
+        self.offsets = np.concatenate(([0], np.cumsum(self.sp_counts)[:-1]))
+    
+    def group_sum(self, values):
+        """Sum of values (one per individual) within each species."""
+        return np.add.reduceat(np.asarray(values)[self.order], self.offsets)
+    
+    def group_mean(self, values):
+        """Mean of values (one per individual) within each species."""
+        return self.group_sum(values) / self.sp_counts
+    
+    def split(self, values):
+        """List of arrays with values (one per individual) for each species."""
+        return np.split(np.asarray(values)[self.order], self.offsets[1:])
+
+class results_store():
+    """Append-only binary columnar store of per-site results for one pattern and model.
+    
+    Each column is a flat file of float64 values under store_dir, and index.json records 
+    the offset and length of each (dataset, site), so that a site's slice is read through 
+    np.memmap without touching the rows of other sites, and optionally a tag (e.g. the provenance 
+    hash of the values). Appending a site that is already in the store replaces its entry in the index. Appends are serialized with a lock file,
+    so that several processes can write to the same store.
+    
+    """
+    def __init__(self, store_dir, columns):
+        self.store_dir = store_dir
+        self.columns = list(columns)
+        self.index_path = os.path.join(store_dir, 'index.json')
+        self._load_index()
+    
+    def _load_index(self):
+        try: 
+            with open(self.index_path) as f:
+                self.entries = json.load(f)['entries']
+        except (IOError, ValueError): self.entries = []
+        self.offsets = OrderedDict(((entry[0], entry[1]), (entry[2], entry[3])) for entry in self.entries)
+        self.tags = dict(((entry[0], entry[1]), entry[4]) for entry in self.entries if len(entry) > 4)
+        self.num_rows = max([offset + length for offset, length in self.offsets.values()] + [0])
+    
+    def _column_path(self, column):
+        return os.path.join(self.store_dir, column + '.f8')
+    
+    def append(self, dataset, site, tag = None, **values):
+        """Append the values of one site, given as one array per column, all with the same length, with an optional tag."""
+        if not os.path.isdir(self.store_dir):
+            try: os.makedirs(self.store_dir)
+            except OSError: pass
+        with profile_stage('write'), open(os.path.join(self.store_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load_index()
+            length = len(values[self.columns[0]])
+            for column in self.columns:
+                with open(self._column_path(column), 'ab') as f:
+                    f.truncate(self.num_rows * 8)  # Drop rows left by an append that did not finish
+                    np.asarray(values[column], dtype = '<f8').tofile(f)
+            self.entries = [entry for entry in self.entries if (entry[0], entry[1]) != (dataset, str(site))]
+            self.entries.append([dataset, str(site), self.num_rows, length] + ([tag] if tag is not None else []))
+            write_file_atomic(self.index_path, json.dumps({'columns': self.columns, 'entries': self.entries}))
+            self._load_index()
+    
+    def sites(self):
+        """List of [dataset, site] in the store, in the order they were added."""
+        return [list(key) for key in self.offsets]
+    
+    def get(self, dataset, site, column):
+        """Memory-mapped values of column for one site."""
+        offset, length = self.offsets[(dataset, str(site))]
+        if length == 0: return np.zeros(0)
+        return np.memmap(self._column_path(column), dtype = '<f8', mode = 'r', offset = offset * 8, shape = (length, ))
+    
+    def read_column(self, column):
+        """All values of column in one read, indexed by the offsets of the sites (see offsets)."""
+        return np.fromfile(self._column_path(column), dtype = '<f8')[:self.num_rows]
+
+class results_cache():
+    """Read-once access to the obs_pred and bootstrap results in out_dir, shared by the plotting functions.
+    
+    The obs_pred values of a pattern and model are read once, from the results store (one read of each 
+    column file) or, for datasets not in the store, from the csv file of the dataset (parsed once and 
+    grouped by site), and kept as views per (dataset, site). Bootstrap results are likewise read once 
+    per pattern, model, and statistic.
+    
+    """
+    def __init__(self, out_dir = './out_files/'):
+        self.out_dir = out_dir
+        self._obs_pred = {}
+        self._store_loaded = set()
+        self._bootstrap = {}
+    
+    def _load_store(self, pattern, model):
+        self._store_loaded.add((pattern, model))
+        store = get_obs_pred_store(pattern, model, out_dir = self.out_dir)
+        if not store.entries: return
+        with profile_stage('read'):
+            obs_all, pred_all = store.read_column('obs'), store.read_column('pred')
+        for (dat_name, site), (offset, length) in store.offsets.items():
+            self._obs_pred.setdefault((pattern, model, dat_name), OrderedDict())[site] = \
+                (obs_all[offset:(offset + length)], pred_all[offset:(offset + length)])
+    
+    def _load_csv(self, pattern, model, dat_name):
+        sites = self._obs_pred[(pattern, model, dat_name)] = OrderedDict()
+        file_path = self.out_dir + dat_name + '_obs_pred_' + pattern + '_' + model + '.csv'
+        get_result_sink().flush()
+        if not os.path.isfile(file_path): return
+        with profile_stage('read'):
+            pred_obs = wk.import_obs_pred_data(file_path)
+        order = np.argsort(pred_obs['site'], kind = 'mergesort')
+        site_names, first = np.unique(pred_obs['site'][order], return_index = True)
+        obs_all, pred_all = np.asarray(pred_obs['obs'], dtype = float)[order], np.asarray(pred_obs['pred'], dtype = float)[order]
+        for site, start, end in zip(site_names, first, list(first[1:]) + [len(order)]):
+            sites[str(site)] = (obs_all[start:end], pred_all[start:end])
+    
+    def get_sites(self, pattern, model, dat_name):
+        """OrderedDict mapping each site of a dataset to its (obs, pred) for a pattern ('rad', 'isd', or 'sdr') and model."""
+        if (pattern, model) not in self._store_loaded: self._load_store(pattern, model)
+        if (pattern, model, dat_name) not in self._obs_pred: self._load_csv(pattern, model, dat_name)
+        return self._obs_pred[(pattern, model, dat_name)]
+    
+    def get_obs_pred_site(self, dat_name, site, pattern, model):
+        """Observed and predicted values for one site, as get_obs_pred_site()."""
+        return self.get_sites(pattern, model, dat_name)[str(site)]
+    
+    def get_obs_pred_datasets(self, dat_list, pattern, model):
+        """Observed and predicted values of all sites in the datasets of dat_list, concatenated."""
+        dat_list = [dat_name for i, dat_name in enumerate(dat_list) if dat_name not in dat_list[:i]]
+        obs_pred = [x for dat_name in dat_list for x in self.get_sites(pattern, model, dat_name).values()]
+        if not obs_pred: return np.zeros(0), np.zeros(0)
+        return np.concatenate([obs for obs, pred in obs_pred]), np.concatenate([pred for obs, pred in obs_pred])
+    
+    def get_rsquare(self, name_site_combo, pattern, model):
+        """R^2 of log10 obs and pred of each [dat_name, site] in name_site_combo, computed for all sites at once."""
+        obs_pred = [self.get_obs_pred_site(dat_name, site, pattern, model) for dat_name, site in name_site_combo]
+        return obs_pred_rsquare_groups(np.log10(np.concatenate([obs for obs, pred in obs_pred])), 
+                                       np.log10(np.concatenate([pred for obs, pred in obs_pred])), 
+                                       [len(obs) for obs, pred in obs_pred])
+    
+    def get_bootstrap_summary(self, pattern, model, stat, Niter = 100):
+        """Summary of the bootstrap results of a statistic (see boot_summary.summarize_bootstrap()) with the first Niter 
+        
+        samples of each site, from the summary table written by merge_bootstrap_units() if available and no site 
+        in it has more than Niter samples, or else computed from get_bootstrap().
+        
+        """
+        key = (pattern, model, stat, Niter, 'summary')
+        if key not in self._bootstrap:
+            summary_file = get_bootstrap_summary_path(pattern, model, stat, out_dir = self.out_dir)
+            summary = None
+            if os.path.isfile(summary_file): 
+                with profile_stage('read'):
+                    summary = np.atleast_1d(boot_summary.import_summary_table(summary_file))
+                if np.any(summary['num_samples'] > Niter): summary = None
+            if summary is None: 
+                summary = boot_summary.summarize_bootstrap(*boot_summary.from_structured(
+                    self.get_bootstrap(pattern, model, stat, Niter = Niter)), dat_type = 'r2' if stat == 'rsquare' else 'ks')
+            self._bootstrap[key] = summary
+        return self._bootstrap[key]
+    
+    def get_bootstrap(self, pattern, model, stat, Niter = 100):
+        """Bootstrap results of a statistic, from the results store if available or else from the combined text file, 
+        
+        in the format of import_bootstrap_file_incomp().
+        
+        """
+        key = (pattern, model, stat, Niter)
+        if key not in self._bootstrap:
+            if get_bootstrap_store(pattern, model, stat, out_dir = self.out_dir).entries: 
+                self._bootstrap[key] = import_bootstrap_store(pattern, model, stat, Niter = Niter, out_dir = self.out_dir)
+            else: 
+                boot_file = self.out_dir + pattern + '_bootstrap_' + model + '_' + stat + '.txt'
+                self._bootstrap[key] = import_bootstrap_file_incomp(boot_file, Niter = Niter)
+        return self._bootstrap[key]
+
+def get_obs_pred_store(pattern, model, out_dir = './out_files/'):
+    """results_store with columns obs and pred for a pattern ('rad', 'isd', or 'sdr') and model."""
+    return results_store(out_dir + 'store/obs_pred_' + pattern + '_' + model, ['obs', 'pred'])
+
+def get_bootstrap_store(pattern, model, stat, out_dir = './out_files/'):
+    """results_store for a bootstrap statistic, with the observed value followed by the sampled values for each site."""
+    return results_store(out_dir + 'store/bootstrap_' + pattern + '_' + model + '_' + stat, ['value'])
+
+def get_bootstrap_summary_path(pattern, model, stat, out_dir = './out_files/'):
+    """Path of the summary table of a bootstrap statistic (see merge_bootstrap_units())."""
+    return out_dir + pattern + '_bootstrap_' + model + '_' + stat + '_summary.csv'
+
+def get_obs_pred_site(dat_name, site, pattern, model, out_dir = './out_files/'):
+    """Observed and predicted values for one site, from the results store if available or else from the csv file."""
+    with profile_stage('read'):
+        store = get_obs_pred_store(pattern, model, out_dir = out_dir)
+        if (dat_name, str(site)) in store.offsets:
+            return store.get(dat_name, site, 'obs'), store.get(dat_name, site, 'pred')
+        get_result_sink().flush()
+        pred_obs = wk.import_obs_pred_data(out_dir + dat_name + '_obs_pred_' + pattern + '_' + model + '.csv')
+        pred_obs_site = pred_obs[pred_obs['site'] == site]
+        return pred_obs_site['obs'], pred_obs_site['pred']
+
+def import_bootstrap_store(pattern, model, stat, Niter = 100, out_dir = './out_files/'):
+    """Read a bootstrap statistic from the results store into the same structured array as import_bootstrap_file_incomp()."""
+    store = get_bootstrap_store(pattern, model, stat, out_dir = out_dir)
+    names = ['dataset', 'site', 'orig'] + ['sample' + str(i) for i in xrange(1, Niter + 1)]
+    data_type = ['S15', 'S15'] + ['f8'] * (Niter + 1)
+    site_list = store.sites()
+    out_array = np.zeros(len(site_list), dtype = {'names': names, 'formats': data_type})
+    for i, (dat_name, site) in enumerate(site_list):
+        values = store.get(dat_name, site, 'value')[:(Niter + 1)]
+        out_array[i] = tuple([dat_name, site] + list(values) + [np.nan] * (Niter + 1 - len(values)))
+    return out_array
 
 def import_likelihood_data(file_name, file_dir = './out_files/'):
     """Import file with likelihood for METE, SSNT, and transformed SSNT"""
+    get_result_sink().flush()
     data = np.genfromtxt(file_dir + file_name, dtype = None, 
                          names = ['study', 'site', 'ASNE', 'AGSNE', 'SSNT_N', 'SSNT_M'], delimiter = ' ')
     return data
@@ -75,20 +386,308 @@ def import_bootstrap_file(input_filename, Niter = 100):
     return data
 
 def import_bootstrap_file_incomp(input_filename, Niter = 100):
-    """The same as import_bootstrap_file, but accounts for instances where the number of columns are not constant."""
-    with open(input_filename) as f:
-        content = f.readlines()    
+    """The same as import_bootstrap_file, but accounts for instances where the number of columns are not constant.
+    
+    Missing samples (e.g. of units stopped early by the sequential bootstrap) are filled with nan.
+    The file is parsed with boot_summary.load_bootstrap_matrix().
+    
+    """
+    dataset, site, orig, samples = boot_summary.load_bootstrap_matrix(input_filename, Niter = Niter)
     names_orig = ['dataset', 'site', 'orig']
     names_sim = ['sample' + str(i) for i in xrange(1, Niter + 1)]
     names = names_orig + names_sim
     data_type = ['S15', 'S15'] + ['f8'] * (Niter + 1)
-    out_array = np.zeros(len(content), dtype = {'names': names, 'formats': data_type})
-    for i, row in enumerate(content):
-        row_split = row.strip(' ').split(',')
-        row_split = [row_split[j] if j < 2 else float(row_split[j]) for j in range(len(row_split))]
-        out_array[i] = tuple(row_split[:(Niter + 3)])
+    out_array = np.zeros(len(orig), dtype = {'names': names, 'formats': data_type})
+    out_array['dataset'], out_array['site'], out_array['orig'] = dataset, site, orig
+    for i, name in enumerate(names_sim):
+        out_array[name] = samples[:, i]
     return out_array
 
+def write_file_atomic(file_path, content):
+    """Write content to file_path through a temporary file in the same directory and a rename, 
+    
+    so that other processes (or a restarted run) never see a partially written file.
+    
+    """
+    file_dir = os.path.dirname(file_path)
+    if file_dir and not os.path.isdir(file_dir):
+        try: os.makedirs(file_dir)
+        except OSError: pass
+    with profile_stage('write'):
+        fd, tmp_path = tempfile.mkstemp(dir = file_dir or '.', suffix = '.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, file_path)
+
+class result_sink():
+    """Buffered writer of rows of text output, appended to their files when flushed.
+    
+    Rows are kept in memory and flushed once max_bytes are buffered or the oldest buffered row is 
+    max_seconds old (checked at each write), or when flush() is called. Each flush appends all the 
+    buffered rows of a file in a single write under an exclusive lock, so that rows from processes 
+    writing to the same file at the same time are never interleaved or cut.
+    
+    """
+    def __init__(self, max_bytes = 2 ** 20, max_seconds = 10):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._buffers = OrderedDict()
+        self._num_bytes = 0
+        self._first_time = None
+    
+    def write(self, file_path, text):
+        """Buffer text, made of complete rows each ending with a newline, to be appended to file_path."""
+        self._buffers.setdefault(file_path, []).append(text)
+        self._num_bytes += len(text)
+        if self._first_time is None: self._first_time = time.time()
+        if self._num_bytes >= self.max_bytes or time.time() - self._first_time >= self.max_seconds: self.flush()
+    
+    def flush(self):
+        """Append the buffered rows to their files."""
+        for file_path, text_list in self._buffers.items():
+            with profile_stage('write'), open(file_path, 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(''.join(text_list))
+                f.flush()
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self._buffers.clear()
+        self._num_bytes = 0
+        self._first_time = None
+
+class queue_sink():
+    """Result sink of a worker in single-writer mode, sending rows to the writer process of start_sink_writer()."""
+    def __init__(self, queue):
+        self.queue = queue
+        self._num_sent = 0
+    
+    def write(self, file_path, text):
+        self.queue.put((file_path, text))
+        self._num_sent += 1
+    
+    def flush(self):
+        """Wait until the writer has written the rows sent since the last flush (and any others it received)."""
+        if self._num_sent == 0: return
+        self.queue.put('flush')
+        self.queue.join()
+        self._num_sent = 0
+
+def get_result_sink():
+    """Result sink of the current process: the one set with set_result_sink(), or else a result_sink 
+    
+    created on first use and flushed at exit. Note that processes started by multiprocessing do not run 
+    exit handlers, so they have to call flush() themselves, as run_analysis_task() does after each task.
+    
+    """
+    global _result_sink
+    if _result_sink is None: 
+        _result_sink = result_sink()
+        atexit.register(_result_sink.flush)
+    return _result_sink
+
+def set_result_sink(sink):
+    """Set the result sink of the current process, e.g. to a queue_sink in the workers of a pool."""
+    global _result_sink
+    _result_sink = sink
+
+def run_sink_writer(queue, max_bytes = 2 ** 20, max_seconds = 10):
+    """Write the rows received through queue with a result_sink until None is received, flushing whenever the queue is idle 
+    
+    or 'flush' is received (see queue_sink.flush()).
+    Items are only marked as done (see multiprocessing.JoinableQueue) once they are written to disk, 
+    so that queue.join() waits until all the rows sent before are in their files.
+    
+    """
+    sink = result_sink(max_bytes = max_bytes, max_seconds = max_seconds)
+    num_pending = 0
+    while True:
+        try: item = queue.get(timeout = 1)
+        except Queue.Empty: item = 'idle'
+        if item in ['idle', 'flush'] or item is None: sink.flush()
+        else: sink.write(*item)
+        if item not in ['idle', None]: num_pending += 1
+        if sink._num_bytes == 0: # Everything received so far is written
+            for i in xrange(num_pending): 
+                queue.task_done()
+            num_pending = 0
+        if item is None: 
+            queue.task_done()
+            break
+
+def start_sink_writer(max_bytes = 2 ** 20, max_seconds = 10):
+    """Start the single writer process of the rows of text output, returning (queue, process).
+    
+    Processes that use queue_sink(queue) as their result sink then never write to the output files 
+    themselves. Stop the writer with stop_sink_writer(), which waits until all rows are written.
+    
+    """
+    queue = multiprocessing.JoinableQueue()
+    writer = multiprocessing.Process(target = run_sink_writer, args = (queue, max_bytes, max_seconds))
+    writer.start()
+    return queue, writer
+
+def stop_sink_writer(queue, writer):
+    """Stop the writer process of start_sink_writer() once it has written all the rows sent before."""
+    queue.put(None)
+    writer.join()
+
+def append_csv_rows(file_path, rows):
+    """Append rows to a csv file through the result sink (see result_sink), 
+    
+    so that rows from processes writing to the same file at the same time are not interleaved.
+    
+    """
+    buf = io.BytesIO()
+    csv.writer(buf).writerows(rows)
+    get_result_sink().write(file_path, buf.getvalue())
+
+def rewrite_rows(file_path, rewrite):
+    """Replace the rows of a text file by rewrite(rows), with rows the list of its lines.
+    
+    The file is rewritten in place under the same lock as result_sink, so that rows appended meanwhile are not lost. 
+    The rows buffered in the result sink of this process are written first.
+    
+    """
+    get_result_sink().flush()
+    if not os.path.isfile(file_path): return
+    with profile_stage('write'), open(file_path, 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        lines = f.readlines()
+        lines_new = rewrite(lines)
+        if lines_new != lines:
+            f.seek(0)
+            f.write(''.join(lines_new))
+            f.truncate()
+            f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def remove_site_rows(file_path, site_fields, delimiter = ','):
+    """Remove the rows of a site from a text file, i.e. those whose first fields equal site_fields 
+    
+    (e.g. [site] for the obs_pred csv files, or [dataset, site] for the likelihood file).
+    
+    """
+    site_fields = [str(field) for field in site_fields]
+    rewrite_rows(file_path, lambda lines: [line for line in lines if 
+                                           line.split(delimiter, len(site_fields))[:len(site_fields)] != site_fields])
+
+def has_site_rows(file_path, site_fields, delimiter = ','):
+    """Whether a text file has rows of a site, i.e. rows whose first fields equal site_fields (see remove_site_rows())."""
+    if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0: return False
+    prefix = delimiter.join([str(field) for field in site_fields]) + delimiter
+    with open(file_path, 'rb') as f:
+        text = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try: return text[:len(prefix)] == prefix or text.find('\n' + prefix) >= 0
+        finally: text.close()
+
+def sort_site_rows(file_path, num_fields, delimiter = ','):
+    """Sort the rows of a text file by their first num_fields fields (e.g. 1 for the site in the obs_pred csv files), 
+    
+    keeping the order of the rows of each site, so that the file does not depend on the order in which 
+    the sites were written.
+    
+    """
+    rewrite_rows(file_path, lambda lines: sorted(lines, key = lambda line: line.split(delimiter, num_fields)[:num_fields]))
+
+class _profile_timer():
+    """Context manager adding the wall time of its block to the profile record with the given key."""
+    def __init__(self, key):
+        self.key = key
+    
+    def __enter__(self):
+        self.start = time.time()
+    
+    def __exit__(self, *exc_info):
+        _profile_add(self.key, time.time() - self.start)
+
+class _null_timer():
+    """Context manager that does nothing, returned by profile_stage() when instrumentation is off."""
+    def __enter__(self): pass
+    
+    def __exit__(self, *exc_info): pass
+
+_null_profile_timer = _null_timer()
+
+def _profile_key(kind, name, tags):
+    all_tags = dict(_profile_tags, **tags)
+    return tuple([kind, name] + ['' if all_tags.get(tag) is None else str(all_tags[tag]) for tag in profile_tag_names])
+
+def _profile_add(key, value):
+    """Add value to the record [count, total, max] of key."""
+    global _profile_pid
+    if _profile_pid != os.getpid(): # Records inherited from the parent process are written by the parent
+        _profile_records.clear()
+        _profile_pid = os.getpid()
+    record = _profile_records.get(key)
+    if record is None: _profile_records[key] = [1, value, value]
+    else:
+        record[0] += 1
+        record[1] += value
+        record[2] = max(record[2], value)
+
+def profile_stage(stage, **tags):
+    """Timer for a block of code, used as "with profile_stage('sample'):".
+    
+    Stages used in this module are 'load', 'clean', 'solve', 'predict', 'likelihood', 'sample', 'statistic', 
+    'read', and 'write'. tags (dataset, site, model, and pattern) override those set with set_profile_tags().
+    When profile_dir is None, a shared context manager that does nothing is returned.
+    
+    """
+    if profile_dir is None: return _null_profile_timer
+    return _profile_timer(_profile_key('timer', stage, tags))
+
+def profile_count(counter, value = 1, **tags):
+    """Add value to a counter, e.g. the number of bootstrap samples drawn, if instrumentation is on."""
+    if profile_dir is None: return
+    _profile_add(_profile_key('counter', counter, tags), value)
+
+def set_profile_tags(**tags):
+    """Set the tags (dataset, site, model, and pattern) of the following timers and counters in this process."""
+    global _profile_tags
+    _profile_tags = tags
+
+def flush_profile():
+    """Write the profile records of this process to its own file in profile_dir."""
+    if profile_dir is None or not _profile_records: return
+    rows = [list(key) + record for key, record in sorted(_profile_records.items())]
+    write_file_atomic(os.path.join(profile_dir, 'profile_' + socket.gethostname() + '_' + str(os.getpid()) + '.json'), 
+                      json.dumps(rows))
+
+def reset_profile():
+    """Clear the profile records of this process and remove the files written to profile_dir by earlier runs."""
+    _profile_records.clear()
+    if profile_dir is None: return
+    for trace_file in glob.glob(os.path.join(profile_dir, 'profile_*.json')):
+        os.remove(trace_file)
+
+def merge_profile(out_file = None):
+    """Combine the profile records written by all processes to profile_dir.
+    
+    Output:
+    A list of dicts with keys 'kind' ('timer' or 'counter'), 'name', the tags, 'count' (number of timed blocks 
+    or increments), 'total' (in seconds for timers), and 'max'. If out_file is given, the list is also written 
+    to it, as csv if its name ends with '.csv' and as json otherwise.
+    
+    """
+    flush_profile()
+    records = OrderedDict()
+    for trace_file in sorted(glob.glob(os.path.join(profile_dir, 'profile_*.json'))):
+        with open(trace_file) as f:
+            for row in json.load(f):
+                key, (count, total, max_value) = tuple(row[:-3]), row[-3:]
+                if key in records:
+                    record = records[key]
+                    records[key] = [record[0] + count, record[1] + total, max(record[2], max_value)]
+                else: records[key] = [count, total, max_value]
+    columns = ['kind', 'name'] + profile_tag_names + ['count', 'total', 'max']
+    out = [dict(zip(columns, list(key) + record)) for key, record in sorted(records.items())]
+    if out_file is not None:
+        if out_file.endswith('.csv'):
+            buf = io.BytesIO()
+            csv.writer(buf).writerows([columns] + [[row[column] for column in columns] for row in out])
+            write_file_atomic(out_file, buf.getvalue())
+        else: write_file_atomic(out_file, json.dumps(out, indent = 1))
+    return out
+
 def clean_data_agsne(raw_data_site, cutoff_genera = 4, cutoff_sp = 9, max_removal = 0.1):
     """Further cleanup of data, removing individuals with undefined genus. 
     
@@ -102,33 +701,213 @@ def clean_data_agsne(raw_data_site, cutoff_genera = 4, cutoff_sp = 9, max_remova
     a structured array with four columns 'site', 'sp', 'genus', and 'dbh'
     
     """
-    counter = 0
-    genus_list = []
-    row_to_remove = []
-    for i, row in enumerate(raw_data_site):
-        sp_split = row['sp'].split(' ')
+    # String work is done once per unique species name and broadcast back to individuals
+    sp_names, sp_inv = np.unique(raw_data_site['sp'], return_inverse = True)
+    genus_names, sp_keep = [], np.zeros(len(sp_names), dtype = bool)
+    for i, sp in enumerate(sp_names):
+        sp_split = sp.split(' ')
         genus = sp_split[0]
-        if len(sp_split) > 1 and genus[0].isupper() and genus[1].islower() and (not any(char.isdigit() for char in genus)):
-            genus_list.append(genus)
-        else: 
-            row_to_remove.append(i)
-            counter += 1
+        genus_names.append(genus)
+        sp_keep[i] = len(sp_split) > 1 and genus[:1].isupper() and genus[1:2].islower() and (not any(char.isdigit() for char in genus))
+    row_keep = sp_keep[sp_inv]
+    counter = len(raw_data_site) - np.count_nonzero(row_keep)
     if counter / len(raw_data_site) <= max_removal:
-        raw_data_site = np.delete(raw_data_site, np.array(row_to_remove), axis = 0)
-        gen_col = np.array(genus_list)
-        out = append_fields(raw_data_site, 'genus', gen_col, usemask = False)
-        if len(np.unique(out['sp'])) > cutoff_sp and len(np.unique(out['genus'])) > cutoff_genera: 
+        gen_col = np.array([genus for genus, keep in zip(genus_names, sp_keep) if keep])
+        if np.count_nonzero(sp_keep) > cutoff_sp and len(np.unique(gen_col)) > cutoff_genera: 
+            out = np.empty(len(row_keep) - counter, dtype = raw_data_site.dtype.descr + [('genus', gen_col.dtype.str)])
+            for name in raw_data_site.dtype.names: 
+                out[name] = raw_data_site[name][row_keep]
+            out['genus'] = gen_col[np.cumsum(sp_keep)[sp_inv[row_keep]] - 1]
             return out
         else: return None
     else: return None
   
-def get_GSNE(raw_data_site):
+def ingest_raw_data(dat_name, in_dir = './data/', cache_dir = None):
+    """Clean all sites of a dataset once and cache them in binary form, returning the site table.
+    
+    The cleaned sites (see clean_data_agsne()) are stored together in a .npy file in cache_dir, 
+    sorted by site and by species within site, and cache_dir + dat_name + '.json' records the name 
+    of that file and the offset and number of rows of each site that passes the cleaning (see 
+    write_data_cache()). cache_dir defaults to in_dir + 'cache/'. The cache is rebuilt when the 
+    size or the modification time of the source csv file changes, or when analysis_version changes 
+    (e.g. after a change to clean_data_agsne() or its cutoffs).
+    
+    """
+    meta = get_data_cache(dat_name, in_dir = in_dir, cache_dir = cache_dir)
+    return [[str(site), offset, length] for site, offset, length in meta['sites']]
+
+def _read_data_cache(dat_name, cache_dir, src_stat):
+    """Meta data of the cache of a dataset (see write_data_cache()), or None if it is missing or stale."""
+    try:
+        with open(cache_dir + dat_name + '.json') as f:
+            meta = json.load(f)
+        if meta['source_size'] == src_stat.st_size and meta['source_mtime'] == src_stat.st_mtime and \
+           meta['analysis_version'] == analysis_version and os.path.isfile(cache_dir + meta['data_file']): 
+            return meta
+    except (IOError, ValueError, KeyError): pass
+    return None
+
+def get_data_cache(dat_name, in_dir = './data/', cache_dir = None):
+    """Meta data of the cache of a dataset (see ingest_raw_data()), which is first built if it is missing or stale.
+    
+    The cache is built under a lock file in cache_dir, so that when several processes (e.g. workers 
+    on several nodes, see run_queue_worker()) find it stale at the same time, only one of them rebuilds it.
+    
+    """
+    if cache_dir is None: cache_dir = in_dir + 'cache/'
+    src_path = in_dir + dat_name + '.csv'
+    src_stat = os.stat(src_path)
+    meta = _read_data_cache(dat_name, cache_dir, src_stat)
+    if meta is not None: return meta
+    
+    if not os.path.isdir(cache_dir):
+        try: os.makedirs(cache_dir)
+        except OSError: pass
+    with open(cache_dir + dat_name + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        meta = _read_data_cache(dat_name, cache_dir, src_stat) # Rebuilt by another process while waiting for the lock
+        if meta is not None: return meta
+        with profile_stage('load', dataset = dat_name):
+            dat = wk.import_raw_data(src_path)
+        site_list, clean_list, offset = [], [], 0
+        for site in np.unique(dat['site']):
+            with profile_stage('clean', dataset = dat_name, site = site):
+                dat_clean = clean_data_agsne(dat[dat['site'] == site])
+            if dat_clean is not None:
+                clean_list.append(dat_clean[np.argsort(dat_clean['sp'], kind = 'mergesort')])
+                site_list.append([str(site), offset, len(dat_clean)])
+                offset += len(dat_clean)
+        if clean_list:
+            genus_len = max([dat_clean.dtype['genus'].itemsize for dat_clean in clean_list])
+            out_dtype = dat.dtype.descr + [('genus', 'S' + str(genus_len))]
+            out = np.concatenate([dat_clean.astype(out_dtype) for dat_clean in clean_list])
+        else: out = np.zeros(0, dtype = dat.dtype.descr + [('genus', 'S1')])
+        return write_data_cache(dat_name, cache_dir, out, site_list, src_stat)
+
+def write_data_cache(dat_name, cache_dir, dat_clean, site_list, src_stat):
+    """Write the cache read by ingest_raw_data() and get_site_data(), returning its meta data.
+    
+    Inputs:
+    dat_clean - cleaned data of all sites, sorted by site and by species within site
+    site_list - list of [site, offset, number of rows] of the sites in dat_clean
+    src_stat - os.stat() of the source csv file, against which the cache is checked
+    
+    The data are written to cache_dir + dat_name + '.' + hash of the data + '.npy', and the meta data, 
+    which refer to that file, are then written to cache_dir + dat_name + '.json'. A reader thus never 
+    pairs the offsets of one version of the cache with the data of another. The data files of earlier 
+    versions are then removed.
+    
+    """
+    if not os.path.isdir(cache_dir):
+        try: os.makedirs(cache_dir)
+        except OSError: pass
+    data_file = dat_name + '.' + hashlib.md5(np.ascontiguousarray(dat_clean).tobytes()).hexdigest() + '.npy'
+    fd, tmp_path = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, dat_clean)
+    os.rename(tmp_path, cache_dir + data_file)
+    meta = {'source_size': src_stat.st_size, 'source_mtime': src_stat.st_mtime, 'analysis_version': analysis_version, 
+            'data_file': data_file, 'sites': site_list}
+    write_file_atomic(cache_dir + dat_name + '.json', json.dumps(meta))
+    for old_file in glob.glob(cache_dir + dat_name + '.*.npy') + glob.glob(cache_dir + dat_name + '.npy'):
+        if os.path.basename(old_file) != data_file: os.remove(old_file)
+    return meta
+
+def get_site_data(dat_name, site, in_dir = './data/', cache_dir = None):
+    """Cleaned data for one site, read from the cache built by ingest_raw_data().
+    
+    Returns the same columns as clean_data_agsne() (with individuals sorted by species), 
+    or None if the site did not pass the cleaning. Only the rows of the site are read from disk, 
+    through a memory map, and copied, so that the data file can be replaced by a rebuild of the cache.
+    
+    """
+    if cache_dir is None: cache_dir = in_dir + 'cache/'
+    for attempt in xrange(2): # The data file may be removed by a rebuild of the cache after the meta data are read
+        meta = get_data_cache(dat_name, in_dir = in_dir, cache_dir = cache_dir)
+        site_rows = dict((site_cache, (offset, length)) for site_cache, offset, length in meta['sites'])
+        if str(site) not in site_rows: return None
+        offset, length = site_rows[str(site)]
+        try: 
+            with profile_stage('load', dataset = dat_name, site = site):
+                return np.array(np.load(cache_dir + meta['data_file'], mmap_mode = 'r')[offset:(offset + length)])
+        except IOError: 
+            if attempt > 0: raise
+  
+def get_site_hash(dat_clean):
+    """Hash of the cleaned data of a site, which does not depend on the width of the string columns in the cache."""
+    site_hash = hashlib.md5()
+    for name in dat_clean.dtype.names:
+        col = np.asarray(dat_clean[name])
+        if col.dtype.kind == 'S': col = col.astype('S' + str(np.max(np.char.str_len(col), initial = 1)))
+        else: col = col.astype('<f8')
+        site_hash.update(name + col.dtype.str)
+        site_hash.update(np.ascontiguousarray(col).tobytes())
+    return site_hash.hexdigest()
+
+def get_input_hash(site_hash, *keys):
+    """Provenance hash of a site-level output, from the hash of the cleaned site data (see get_site_hash()), 
+    
+    keys that identify the output and its parameters (e.g. pattern and model), and analysis_version.
+    
+    """
+    return hashlib.md5('_'.join([str(analysis_version), site_hash] + [str(key) for key in keys])).hexdigest()
+
+def get_GSNE(raw_data_site, site_idx = None):
     """Obtain the state variables given data for a single site, returned by clean_data_genera()."""
-    G = len(np.unique(raw_data_site['genus']))
-    S = len(np.unique(raw_data_site['sp']))
-    N = len(raw_data_site)
+    if site_idx is not None: 
+        G, S, N = site_idx.G, site_idx.S, site_idx.N
+    else:
+        G = len(np.unique(raw_data_site['genus']))
+        S = len(np.unique(raw_data_site['sp']))
+        N = len(raw_data_site)
     E = sum((raw_data_site['dbh'] / min(raw_data_site['dbh'])) ** 2)
     return G, S, N, E
+
+def get_par_cached(model, stat_var, solver):
+    """Return the parameters of model for the given state variables, solving them only once.
+    
+    Inputs:
+    model - name of the parameter set, e.g. 'agsne' or 'beta_untruncated'
+    stat_var - list of state variables that fully determine the parameters
+    solver - function taking no argument that solves the parameters if they are not cached
+    
+    Values are looked up first in memory, then in par_cache_dir. Files on disk are written to a 
+    temporary file and renamed into place, so that concurrent workers never see partial entries.
+    
+    """
+    key = model + '_' + '_'.join(repr(float(x)) for x in stat_var)
+    if key in _par_cache:
+        _par_cache[key] = _par_cache.pop(key)
+        return _par_cache[key]
+    par = None
+    if par_cache_dir is not None:
+        par_path = os.path.join(par_cache_dir, hashlib.md5(key).hexdigest() + '.json')
+        try: 
+            with open(par_path) as f:
+                entry = json.load(f)
+            if entry['key'] == key: par = entry['par']
+        except (IOError, ValueError, KeyError): pass
+    if par is None:
+        profile_count('par_cache_miss')
+        with profile_stage('solve'):
+            par = solver()
+        par = [float(x) for x in par] if np.ndim(par) else float(par)
+        if par_cache_dir is not None: write_file_atomic(par_path, json.dumps({'key': key, 'par': par}))
+    _par_cache[key] = par
+    while len(_par_cache) > par_cache_size: 
+        _par_cache.popitem(last = False)
+    return par
+
+def get_beta_cached(S, N, version = 'precise'):
+    """Cached version of mete.get_beta()."""
+    return get_par_cached('beta_' + version, [S, N], lambda: mete.get_beta(S, N, version = version))
+
+def get_agsne_pars(G, S, N, E):
+    """Cached parameters [lambda1, beta, lambda3, z] of AGSNE."""
+    def solve_agsne():
+        lambda1, beta, lambda3 = agsne.get_agsne_lambdas(G, S, N, E)
+        return [lambda1, beta, lambda3, agsne.agsne_lambda3_z(lambda1, beta, S) / lambda3]
+    return get_par_cached('agsne', [G, S, N, E], solve_agsne)
     
 def lik_sp_abd_dbh_ssnt(stat_var, beta, model, n, dbh_list, d_list_full, log = True):
     """Probability of a species having abundance n and its individuals having dbh [d1, d2, ..., d_n] in SSNT
@@ -142,14 +921,13 @@ def lik_sp_abd_dbh_ssnt(stat_var, beta, model, n, dbh_list, d_list_full, log = T
     d_list_full - a list or array of scaled dbh values for all individuals in community
     """
     G, S, N, E = stat_var
-    alpha_model = {'ssnt_0': 1, 'ssnt_1': 2/3}
-    alpha = alpha_model[model]
-    par = N / (sum(np.array(d_list_full)**alpha) - N)
+    alpha = ssnt_alpha[model]
+    par = N / (np.sum(np.asarray(d_list_full) ** alpha) - N)
     p_sad_log = stats.logser.logpmf(n, beta)
     isd = ssnt_isd_bounded(alpha, par)
-    p_dbh = [isd.pdf(d) for d in dbh_list]
-    if log: return p_sad_log + sum([np.log(p_ind) for p_ind in p_dbh])
-    else: return np.exp(p_sad_log + sum([np.log(p_ind) for p_ind in dbh_list]))
+    p_dbh_log = np.sum(isd.logpdf(dbh_list))
+    if log: return p_sad_log + p_dbh_log
+    else: return np.exp(p_sad_log + p_dbh_log)
     
 def lik_sp_abd_dbh_asne(stat_var, beta, n, dbh_list, log = True):
     """Probability of a species having abundance n and its individuals having dbh [d1, d2, ..., d_n] in METE
@@ -195,7 +973,27 @@ def lik_sp_abd_dbh_agsne(stat_var, pars, n, dbh_list, log = True):
     if log == True: return logp
     else: return np.exp(logp)
     
-def get_obs_pred_sad(raw_data_site, dataset_name, model, out_dir = './out_files/'):
+def write_obs_pred(obs, pred, dataset_name, site, pattern, model, out_dir = './out_files/', dtype = 'S15, f8, f8'):
+    """Write the observed and predicted values of a site for a pattern ('rad', 'isd', or 'sdr') and model 
+    
+    to the csv file of the dataset, with one row (site, obs, pred) for each value, and to the results store.
+    
+    """
+    results = np.zeros((len(obs), ), dtype = dtype)
+    results['f0'] = site
+    results['f1'] = obs
+    results['f2'] = pred
+    append_csv_rows(out_dir + dataset_name + '_obs_pred_' + pattern + '_' + model + '.csv', results)
+    get_obs_pred_store(pattern, model, out_dir = out_dir).append(dataset_name, site, obs = obs, pred = pred)
+
+def get_pred_sad(model, G, S, N, E):
+    """Predicted RAD of a model, 'ssnt' (the same for both versions of SSNT), 'asne', or 'agsne'."""
+    with profile_stage('predict'):
+        if model == 'ssnt': return mete.get_mete_rad(S, N, version = 'untruncated')[0]
+        elif model == 'asne': return mete.get_mete_rad(S, N)[0]
+        elif model == 'agsne': return agsne.get_mete_agsne_rad(G, S, N, E)
+
+def get_obs_pred_sad(raw_data_site, dataset_name, model, out_dir = './out_files/', site_idx = None):
     """Write the observed and predicted RAD to file for a given model.
     
     Inputs:
@@ -205,38 +1003,86 @@ def get_obs_pred_sad(raw_data_site, dataset_name, model, out_dir = './out_files/
     model - can take one of three values 'ssnt', 'asne', or 'agsne'. Note that the predicted SAD for SSNT does not 
         change with alternative scaling of D.
     out_dir - directory for output file.
+    site_idx - site_index of raw_data_site, built here if not provided.
+    
+    """
+    if site_idx is None: site_idx = site_index(raw_data_site)
+    G, S, N, E = get_GSNE(raw_data_site, site_idx)
+    pred = get_pred_sad(model, G, S, N, E)
+    obs = np.sort(site_idx.sp_counts)[::-1]
+    for model_store in (['ssnt_0', 'ssnt_1'] if model == 'ssnt' else [model]):
+        write_obs_pred(obs, pred, dataset_name, raw_data_site['site'][0], 'rad', model_store, out_dir = out_dir, 
+                       dtype = 'S15, i8, i8')
+
+def _invert_cdf_table(log_grid, dens, q):
+    """Quantiles q from a density tabulated on a grid of log(x), using a trapezoidal cdf and linear interpolation."""
+    cdf = np.concatenate(([0], np.cumsum((dens[1:] + dens[:-1]) / 2 * np.diff(log_grid))))
+    cdf = cdf / cdf[-1]
+    keep = np.concatenate(([True], np.diff(cdf) > 0)) # np.interp needs an increasing cdf
+    return np.exp(np.interp(q, cdf[keep], log_grid[keep]))
+
+def get_isd_quantiles(dist, q, lower, upper, exact = False, rtol = 1e-6, num_grid = 1025, max_grid = 65537):
+    """Quantiles of a continuous distribution with a scalar pdf, such as psi_epsilon_approx or psi_agsne.
+    
+    Instead of numerically inverting the cdf once for each quantile, the pdf is tabulated on a grid 
+    that is uniform in log(x) between lower and upper, integrated into a monotone cdf table, and all 
+    quantiles are obtained by interpolation. The grid is refined by inserting midpoints until the 
+    quantiles change by less than rtol (relative), or the grid reaches max_grid points.
+    
+    Inputs:
+    dist - distribution with methods pdf() and, for exact = True, ppf()
+    q - array of probabilities
+    lower, upper - bounds of the distribution
+    exact - if True, calls dist.ppf() for each quantile instead, e.g. to check the accuracy
+    
+    """
+    q = np.asarray(q, dtype = float)
+    if exact: return np.array([dist.ppf(x) for x in q])
+    log_grid = np.linspace(np.log(lower), np.log(upper), num_grid)
+    dens = np.array([dist.pdf(x) for x in np.exp(log_grid)]) * np.exp(log_grid) # Density of log(x)
+    quan = _invert_cdf_table(log_grid, dens, q)
+    while len(log_grid) < max_grid:
+        log_mid = (log_grid[:-1] + log_grid[1:]) / 2
+        dens_mid = np.array([dist.pdf(x) for x in np.exp(log_mid)]) * np.exp(log_mid)
+        log_grid = np.insert(log_grid, np.arange(1, len(log_grid)), log_mid)
+        dens = np.insert(dens, np.arange(1, len(dens)), dens_mid)
+        quan_new = _invert_cdf_table(log_grid, dens, q)
+        converged = np.max(np.abs(quan_new - quan) / quan) < rtol
+        quan = quan_new
+        if converged: break
+    return quan
+
+def get_mete_pred_isd_approx(S, N, E, exact = False):
+    """Obtain the dbh2 for N individuals predicted by METE, using the newly derived approximated ISD.
+    
+    See get_isd_quantiles() for exact.
     
     """
-    G, S, N, E = get_GSNE(raw_data_site)
-    if model == 'ssnt': 
-        pred = mete.get_mete_rad(S, N, version = 'untruncated')[0]
-    elif model == 'asne': 
-        pred = mete.get_mete_rad(S, N)[0]
-    elif model == 'agsne': 
-        pred = agsne.get_mete_agsne_rad(G, S, N, E)
-    obs = np.sort([len(raw_data_site[raw_data_site['sp'] == sp]) for sp in np.unique(raw_data_site['sp'])])[::-1]
-    results = np.zeros((S, ), dtype = ('S15, i8, i8'))
-    results['f0'] = np.array([raw_data_site['site'][0]] * S)
-    results['f1'] = obs
-    results['f2'] = pred    
-    
-    if model == 'ssnt': 
-        f1_write = open(out_dir + dataset_name + '_obs_pred_rad_ssnt_0.csv', 'ab')
-        f2_write = open(out_dir + dataset_name + '_obs_pred_rad_ssnt_1.csv', 'ab')
-        f2 = csv.writer(f2_write)
-        f2.writerows(results)
-        f2_write.close()
-    else: f1_write = open(out_dir + dataset_name + '_obs_pred_rad_' + model + '.csv', 'ab')
-    f1 = csv.writer(f1_write)
-    f1.writerows(results)
-    f1_write.close()
-
-def get_mete_pred_isd_approx(S, N, E):
-    """Obtain the dbh2 for N individuals predicted by METE, using the newly derived approximated ISD."""
     psi_appox = mete_distributions.psi_epsilon_approx(S, N, E)
-    scaled_rank = [(x + 0.5) / N for x in range(N)]
-    pred = np.array([psi_appox.ppf(q) for q in scaled_rank])
-    return np.array(pred)
+    scaled_rank = (np.arange(N) + 0.5) / N
+    return get_isd_quantiles(psi_appox, scaled_rank, 1, E, exact = exact)
+
+def get_agsne_pred_isd(G, S, N, E, exact = False):
+    """Obtain the dbh2 for N individuals predicted by AGSNE at the same scaled ranks as get_mete_pred_isd_approx()."""
+    psi = mete_distributions.psi_agsne([G, S, N, E], get_agsne_pars(G, S, N, E))
+    scaled_rank = (np.arange(N) + 0.5) / N
+    return get_isd_quantiles(psi, scaled_rank, 1, E, exact = exact)
+
+def get_pred_isd(model, G, S, N, E, dbh_scaled):
+    """Predicted diameters (scaled by the smallest one) of the N individuals of a site at scaled ranks (i + 0.5) / N.
+    
+    dbh_scaled - observed diameters scaled by the smallest one, which determine the parameter of SSNT
+    
+    """
+    with profile_stage('predict'):
+        if model == 'asne':  # Note both ASNE and AGSNE return values in diameter^2, which needs to be transformed back
+            return get_mete_pred_isd_approx(S, N, E) ** 0.5
+        elif model == 'agsne': 
+            return get_agsne_pred_isd(G, S, N, E) ** 0.5
+        else: 
+            alpha = ssnt_alpha[model]
+            isd_ssnt = ssnt_isd_bounded(alpha, N / (np.sum(dbh_scaled ** alpha) - N))
+            return isd_ssnt.ppf((np.arange(N) + 0.5) / N)
 
 def get_obs_pred_isd(raw_data_site, dataset_name, model, out_dir = './out_files/'):
     """Write the observed and predicted ISD to file for a given model.
@@ -251,31 +1097,33 @@ def get_obs_pred_isd(raw_data_site, dataset_name, model, out_dir = './out_files/
     
     """
     G, S, N, E = get_GSNE(raw_data_site)
-    if model == 'asne':  # Note both ASNE and AGSNE return values in diameter^2, which needs to be transformed back
-        pred = get_mete_pred_isd_approx(range(1, N + 1), S, N, E) ** 0.5
-    elif model == 'agsne': 
-        pred = np.array(agsne.get_mete_agsne_isd(G, S, N, E)) ** 0.5
-    else: 
-        dbh_scaled = np.array(raw_data_site['dbh'] / min(raw_data_site['dbh']))
-        if model == 'ssnt_0': alpha = 1
-        elif model == 'ssnt_1': alpha = 2/3
-        par = N / (sum(dbh_scaled ** alpha) - N)
-        scaled_rank = [(x + 0.5) / N for x in range(N)]
-        isd_ssnt = ssnt_isd_bounded(alpha, par)
-        pred = np.array([isd_ssnt.ppf(q) for q in scaled_rank])
-        
-    obs = np.sort(raw_data_site['dbh'] / min(raw_data_site['dbh']))
-    results = np.zeros((N, ), dtype = ('S15, f8, f8'))
-    results['f0'] = np.array([raw_data_site['site'][0]] * N)
-    results['f1'] = obs
-    results['f2'] = pred    
+    dbh_scaled = np.asarray(raw_data_site['dbh'] / min(raw_data_site['dbh']), dtype = float)
+    pred = get_pred_isd(model, G, S, N, E, dbh_scaled)
+    write_obs_pred(np.sort(dbh_scaled), pred, dataset_name, raw_data_site['site'][0], 'isd', model, out_dir = out_dir)
+
+def get_pred_sdr(model, G, S, N, E, dbh_scaled, site_idx):
+    """Predicted average D^2 (scaled by the smallest D) within each species, in the order of site_idx.
+    
+    Only the distribution of the given model is built, and for ASNE and AGSNE the expected value is 
+    computed once for each distinct abundance n (and number m of species within the genus for AGSNE).
     
-    f1_write = open(out_dir + dataset_name + '_obs_pred_isd_' + model + '.csv', 'ab')
-    f1 = csv.writer(f1_write)
-    f1.writerows(results)
-    f1_write.close()
+    """
+    with profile_stage('predict'):
+        if model in ['ssnt_0', 'ssnt_1']: # P(d|n) is the community ISD for all species
+            alpha = ssnt_alpha[model]
+            iisd_ssnt = ssnt_isd_bounded(alpha, N / (np.sum(dbh_scaled ** alpha) - N))
+            return np.repeat(iisd_ssnt.expected_square(), S)
+        # n is the number of individuals within species, m the number of species within its genus
+        if model == 'asne': 
+            theta_asne = mete_distributions.theta_epsilon(S, N, E)
+            n_unique, sp_inv = np.unique(site_idx.sp_counts, return_inverse = True)
+            return np.array([theta_asne.E(n) for n in n_unique])[sp_inv]
+        else:
+            theta_agsne = mete_distributions.theta_agsne([G, S, N, E], get_agsne_pars(G, S, N, E))
+            nm_unique, sp_inv = np.unique(site_idx.sp_counts * (S + 1) + site_idx.sp_m, return_inverse = True)
+            return np.array([theta_agsne.expected(nm % (S + 1), nm // (S + 1)) for nm in nm_unique])[sp_inv]
 
-def get_obs_pred_sdr(raw_data_site, dataset_name, model, out_dir = './out_files/'):
+def get_obs_pred_sdr(raw_data_site, dataset_name, model, out_dir = './out_files/', site_idx = None):
     """Write the observed and predicted SDR (in unit of D^2) to file for a given model.
     
     Inputs:
@@ -285,95 +1133,321 @@ def get_obs_pred_sdr(raw_data_site, dataset_name, model, out_dir = './out_files/
     model - can take one of four values 'ssnt_0' (constant growth of diameter D), 
         'ssnt_1' (constant growth of D^2/3), 'asne', or 'agsne'. 
     out_dir - directory for output file.
+    site_idx - site_index of raw_data_site, built here if not provided.
     
     """
-    scaled_d = raw_data_site['dbh'] / min(raw_data_site['dbh'])
-    scaled_d2 = scaled_d **2
-    G, S, N, E = get_GSNE(raw_data_site)
-    lambda1, beta, lambda3 = agsne.get_agsne_lambdas(G, S, N, E)
-    theta_agsne = mete_distributions.theta_agsne([G, S, N, E], [lambda1, beta, lambda3, agsne.agsne_lambda3_z(lambda1, beta, S) / lambda3])
-    theta_asne = mete_distributions.theta_epsilon(S, N, E)
-    if model == 'ssnt_1': alpha = 2/3
-    else: alpha = 1
-    par = N / (sum(scaled_d ** alpha) - N)
-    iisd_ssnt = ssnt_isd_bounded(alpha, par)
-   
-    pred, obs = [], []
-    for sp in np.unique(raw_data_site['sp']):
-        n = len(raw_data_site[raw_data_site['sp'] == sp]) # Number of individuals within species
-        if model == 'agsne': 
-            genus_sp = raw_data_site['genus'][raw_data_site['sp'] == sp][0]
-            m = len(np.unique(raw_data_site['sp'][raw_data_site['genus'] == genus_sp])) # Number of specis within genus
-            pred.append(theta_agsne.expected(m, n))
-        elif model == 'asne': pred.append(theta_asne.E(n))
-        elif model in ['ssnt_0', 'ssnt_1']: pred.append(iisd_ssnt.expected_square())
-        obs.append(np.mean(scaled_d2[raw_data_site['sp'] == sp]))
-    
-    results = np.zeros((S, ), dtype = ('S15, f8, f8'))
-    results['f0'] = np.array([raw_data_site['site'][0]] * S)
-    results['f1'] = obs
-    results['f2'] = pred    
-    f1_write = open(out_dir + dataset_name + '_obs_pred_sdr_' + model + '.csv', 'ab')
-    f1 = csv.writer(f1_write)
-    f1.writerows(results)
-    f1_write.close()
+    if site_idx is None: site_idx = site_index(raw_data_site)
+    G, S, N, E = get_GSNE(raw_data_site, site_idx)
+    dbh_scaled = np.asarray(raw_data_site['dbh'] / min(raw_data_site['dbh']), dtype = float)
+    pred = get_pred_sdr(model, G, S, N, E, dbh_scaled, site_idx)
+    obs = site_idx.group_mean(dbh_scaled ** 2)
+    write_obs_pred(obs, pred, dataset_name, raw_data_site['site'][0], 'sdr', model, out_dir = out_dir)
                 
-def get_isd_lik_three_models(dat_list, out_dir = './out_files/', cutoff = 9):
+def get_ssnt_isd_loglik_alphas(dbh_scaled, alpha_list, max_values = 10 ** 7):
+    """Log-likelihood of the ISD of a site under SSNT for each alpha in alpha_list, all in one vectorized pass.
+    
+    Inputs:
+    dbh_scaled - array of diameters of all individuals in the site, scaled by the smallest one
+    alpha_list - powers of diameter with constant growth in SSNT, all positive
+    max_values - maximal number of values of D^alpha held in memory at once
+    
+    Output:
+    Arrays with the log-likelihood and the MLE of the parameter of ssnt_isd_bounded() for each alpha. 
+    log(D) is computed once for each distinct diameter and reused for all alphas. With the parameter 
+    at its MLE par = N / sum(D^alpha - 1), the log-likelihood reduces to 
+    N * log(alpha * par) - N + (alpha - 1) * sum(log(D)).
+    
+    """
+    dbh_unique, dbh_counts = np.unique(np.asarray(dbh_scaled, dtype = float), return_counts = True)
+    log_dbh = np.log(dbh_unique)
+    alpha_arr = np.atleast_1d(np.asarray(alpha_list, dtype = float))
+    N = np.sum(dbh_counts)
+    sum_d_alpha = np.zeros(len(alpha_arr)) # sum(D^alpha - 1), with expm1 to keep the precision for small alpha
+    num_alpha = max(1, max_values // len(log_dbh))
+    for start in xrange(0, len(alpha_arr), num_alpha):
+        sum_d_alpha[start:(start + num_alpha)] = np.dot(np.expm1(np.outer(alpha_arr[start:(start + num_alpha)], log_dbh)), dbh_counts)
+    par = N / sum_d_alpha
+    loglik = N * np.log(alpha_arr * par) - N + (alpha_arr - 1) * np.dot(dbh_counts, log_dbh)
+    return loglik, par
+
+def get_isd_loglik_site(dbh_scaled, S0, N0, alpha_list = (1, 2/3)):
+    """Log-likelihood of the ISD of a site under METE and SSNT with each alpha in alpha_list.
+    
+    Inputs:
+    dbh_scaled - array of diameters of all individuals in the site, scaled by the smallest one
+    S0, N0 - number of species and individuals
+    alpha_list - powers of diameter with constant growth in SSNT (1 for SSNT on D, 2/3 for SSNT on D**(2/3))
+    
+    Output:
+    List with the log-likelihood of METE followed by those of SSNT for each alpha. 
+    The pdf of METE (psi_epsilon, which is on dbh**2) takes scalars, so it is evaluated once for each 
+    distinct diameter, as diameters are recorded with limited precision.
+    
+    """
+    dbh_scaled = np.asarray(dbh_scaled, dtype = float)
+    psi = mete_distributions.psi_epsilon(S0, N0, np.sum(dbh_scaled ** 2))
+    dbh_unique, dbh_counts = np.unique(dbh_scaled, return_counts = True)
+    psi_unique = np.array([psi.pdf(dbh ** 2) for dbh in dbh_unique])
+    lik = [np.sum(dbh_counts * np.log(psi_unique * 2 * dbh_unique))]
+    return lik + list(get_ssnt_isd_loglik_alphas(dbh_scaled, alpha_list)[0])
+
+def get_isd_lik_three_models(dat_list, out_dir = './out_files/', cutoff = 9, alpha_list = (1, 2/3)):
     """Function to obtain the community-level log-likelihood (standardized by the number of individuals)
     
     as well as AICc values for METE, SSNT on D, and SSNT on D**(2/3) and write to files. 
+    alpha_list - powers of diameter with constant growth for the SSNT models, one column each in the output
+    
+    The rows of all sites are written to each file in a single write at the end.
     
     """
+    lik_rows, aicc_rows = [], []
     for dat_name in dat_list:
         dat = wk.import_raw_data('./data/' + dat_name + '.csv')
-        for site in np.unique(dat['site']):
-            dat_site = dat[dat['site'] == site]
+        order = np.argsort(dat['site'], kind = 'mergesort')
+        site_list, site_start = np.unique(dat['site'][order], return_index = True)
+        for site, dat_site in zip(site_list, np.split(dat[order], site_start[1:])):
             S0 = len(np.unique(dat_site['sp']))
             if S0 > cutoff:
                 N0 = len(dat_site)
                 dbh_scaled = dat_site['dbh'] / min(dat_site['dbh'])
-                psi = mete_distributions.psi_epsilon(S0, N0, sum(dbh_scaled ** 2))
-                ssnt_isd = ssnt_isd_bounded(1, N0 / (sum(dbh_scaled) - N0))
-                ssnt_isd_transform = ssnt_isd_bounded(2/3, N0 / (sum(dbh_scaled ** (2/3)) - N0))
-                
-                lik_mete, lik_ssnt, lik_ssnt_transform = 0, 0, 0
-                for dbh in dbh_scaled:
-                    lik_mete += np.log(psi.pdf(dbh ** 2) * 2 * dbh) # psi is on dbh**2
-                    lik_ssnt += np.log(ssnt_isd.pdf(dbh))
-                    lik_ssnt_transform += np.log(ssnt_isd_transform.pdf(dbh))
-                out1 = open(out_dir + 'isd_lik_three_models.txt', 'a')
-                print>>out1, dat_name, site, str(lik_mete / N0), str(lik_ssnt / N0), str(lik_ssnt_transform / N0)
-                out1.close()
-                
-                out2 = open(out_dir + 'isd_aicc_three_models.txt', 'a')
+                lik = get_isd_loglik_site(dbh_scaled, S0, N0, alpha_list = alpha_list)
+                lik_rows.append(' '.join([dat_name, str(site)] + [str(x / N0) for x in lik]))
                 # METE has three parameters (S0, N0, E0) for ISD, while SSNT has two (N0 and sum(dbh**alpha))
-                print>>out2, dat_name, site, str(mtools.AICc(lik_mete, 3, N0)), str(mtools.AICc(lik_ssnt, 2, N0)), \
-                     str(mtools.AICc(lik_ssnt_transform, 2, N0))
-                out2.close()
+                aicc_rows.append(' '.join([dat_name, str(site), str(mtools.AICc(lik[0], 3, N0))] + 
+                                          [str(mtools.AICc(x, 2, N0)) for x in lik[1:]]))
+    for file_name, rows in [('isd_lik_three_models.txt', lik_rows), ('isd_aicc_three_models.txt', aicc_rows)]:
+        if rows: get_result_sink().write(out_dir + file_name, '\n'.join(rows) + '\n')
+    get_result_sink().flush()
                 
-def get_lik_sp_abd_dbh_four_models(raw_data_site, dataset_name, out_dir = './out_files/'):
+def get_lik_sp_abd_dbh_community(raw_data_site, site_idx = None, models = ('asne', 'agsne', 'ssnt_0', 'ssnt_1')):
+    """Summed log likelihood over all species in a site for the four models, scoring all individuals at once.
+    
+    Returns a dictionary with keys in models (by default 'asne', 'agsne', 'ssnt_0', and 'ssnt_1'), which equal the sums of 
+    lik_sp_abd_dbh_asne(), lik_sp_abd_dbh_agsne() and lik_sp_abd_dbh_ssnt() over species.
+    
+    """
+    if site_idx is None: site_idx = site_index(raw_data_site)
+    G, S, N, E = get_GSNE(raw_data_site, site_idx)
+    d_list = np.asarray(raw_data_site['dbh'] / min(raw_data_site['dbh']), dtype = float)
+    log_2d = np.log(2 * d_list)
+    n_sp = site_idx.sp_counts
+    n_ind = n_sp[site_idx.sp_codes].astype(float)  # Abundance of the species of each individual
+    lik = {}
+    
+    # ASNE: theta_epsilon (Eqn 7.25) evaluated on d^2 and transformed back to d
+    if 'asne' in models:
+        beta_asne = get_beta_cached(S, N)
+        theta = mete_distributions.theta_epsilon(S, N, E)
+        log_norm = -theta.beta * n_ind + np.log(-np.expm1(-(theta.sigma - theta.beta) * n_ind))
+        p_dbh_log = np.log(theta.lambda2 * n_ind) - (theta.lambda1 + theta.lambda2 * d_list ** 2) * n_ind - log_norm + log_2d
+        lik['asne'] = np.sum(md.trunc_logser.logpmf(n_sp, np.exp(-beta_asne), N)) + np.sum(p_dbh_log)
+    
+    # AGSNE
+    if 'agsne' in models:
+        lambda1, beta, lambda3, z = agsne_pars = get_agsne_pars(G, S, N, E)
+        sad = mete_distributions.sad_agsne([G, S, N, E], agsne_pars)
+        logt = -(lambda1 + (beta - lambda3) * n_ind + lambda3 * n_ind * (d_list ** 2))
+        p_dbh_log = logt - 2 * np.log(-np.expm1(logt)) + np.log(1 - (S + 1) * np.exp(S * logt) + S * np.exp((S + 1) * logt)) + log_2d
+        sad_logpmf = np.array([sad.logpmf(n) for n in n_sp])
+        lik['agsne'] = np.sum(p_dbh_log) + np.sum(n_sp * np.log(G / S / z) - (n_sp - 1) * sad_logpmf)
+    
+    # SSNT: P(d|n) is the community ISD, so the individuals do not depend on species
+    ssnt_models = [model for model in ['ssnt_0', 'ssnt_1'] if model in models]
+    if ssnt_models:
+        lik_ssnt = get_lik_sp_abd_dbh_ssnt_alphas(raw_data_site, [ssnt_alpha[model] for model in ssnt_models], site_idx = site_idx)
+        lik.update(zip(ssnt_models, lik_ssnt))
+    return lik
+
+def get_lik_sp_abd_dbh_four_models(raw_data_site, dataset_name, out_dir = './out_files/', site_idx = None):
     """Obtain the summed log likelihood of each species having abundance n and its individuals having 
     
     their specific dbh values for the three models METE, SSNT on D, and SSNT on D ** (2/3).
+    site_idx - site_index of raw_data_site, built here if not provided.
     
     """
     site = raw_data_site['site'][0]
-    G, S, N, E = get_GSNE(raw_data_site)
-    lambda1, beta, lambda3 = agsne.get_agsne_lambdas(G, S, N, E)
-    beta_ssnt = mete.get_beta(S, N, version = 'untruncated')
-    beta_asne = mete.get_beta(S, N) 
-    d_list = raw_data_site['dbh'] / min(raw_data_site['dbh'])
-    lik_asne, lik_agsne, lik_ssnt_0, lik_ssnt_1 = 0, 0, 0, 0
-    for sp in np.unique(raw_data_site['sp']):
-        sp_dbh = d_list[raw_data_site['sp'] == sp]
-        lik_asne += lik_sp_abd_dbh_asne([G, S, N, E], np.exp(-beta_asne), len(sp_dbh), sp_dbh)
-        lik_agsne += lik_sp_abd_dbh_agsne([G, S, N, E], 
-                                          [lambda1, beta, lambda3, agsne.agsne_lambda3_z(lambda1, beta, S) / lambda3], len(sp_dbh), sp_dbh)
-        lik_ssnt_0 += lik_sp_abd_dbh_ssnt([G, S, N, E], np.exp(-beta_ssnt), 'ssnt_0', len(sp_dbh), sp_dbh, d_list)
-        lik_ssnt_1 += lik_sp_abd_dbh_ssnt([G, S, N, E], np.exp(-beta_ssnt), 'ssnt_1', len(sp_dbh), sp_dbh, d_list)
-    out = open(out_dir + 'lik_sp_abd_dbh_four_models.txt', 'a')
-    print>>out, dataset_name, site, str(lik_asne), str(lik_agsne), str(lik_ssnt_0), str(lik_ssnt_1)
-    out.close()    
+    with profile_stage('likelihood'):
+        lik = get_lik_sp_abd_dbh_community(raw_data_site, site_idx = site_idx)
+    lik_asne, lik_agsne, lik_ssnt_0, lik_ssnt_1 = lik['asne'], lik['agsne'], lik['ssnt_0'], lik['ssnt_1']
+    get_result_sink().write(out_dir + 'lik_sp_abd_dbh_four_models.txt', 
+                            ' '.join([dataset_name, str(site), str(lik_asne), str(lik_agsne), str(lik_ssnt_0), str(lik_ssnt_1)]) + '\n')
+
+def get_lik_sp_abd_dbh_ssnt_alphas(raw_data_site, alpha_list, site_idx = None):
+    """Summed log likelihood of the abundances of all species in a site and the diameters of their individuals 
+    
+    under SSNT for each alpha in alpha_list, as in get_lik_sp_abd_dbh_community() for 'ssnt_0' and 'ssnt_1'.
+    The SAD of SSNT does not depend on alpha, and the ISD is evaluated with get_ssnt_isd_loglik_alphas().
+    
+    """
+    if site_idx is None: site_idx = site_index(raw_data_site)
+    S, N = site_idx.S, site_idx.N
+    d_list = np.asarray(raw_data_site['dbh'] / min(raw_data_site['dbh']), dtype = float)
+    lik_sad_ssnt = np.sum(stats.logser.logpmf(site_idx.sp_counts, np.exp(-get_beta_cached(S, N, version = 'untruncated'))))
+    return lik_sad_ssnt + get_ssnt_isd_loglik_alphas(d_list, alpha_list)[0]
+
+def get_ssnt_alpha_mle(dbh_scaled, alpha_grid = None, ci_level = 0.95):
+    """Profile-likelihood MLE of alpha in SSNT for a site, with its confidence interval.
+    
+    The parameter of the ISD is profiled out at its MLE for each alpha (see get_ssnt_isd_loglik_alphas()). 
+    As the SAD of SSNT does not depend on alpha, this is also the MLE for the joint likelihood of abundances 
+    and diameters. The maximum is located on alpha_grid, then refined between its neighbours on the grid 
+    (it is thus at the edge of alpha_grid if it lies outside). The bounds of the confidence interval are 
+    where the profile log-likelihood is chi2(1).ppf(ci_level) / 2 below its maximum, or nan if not within alpha_grid. 
+    alpha_grid defaults to 60 values evenly spaced from 0.05 to 3.
+    Output:
+    alpha_mle, lower, upper, and the log-likelihood of the ISD at alpha_mle
+    
+    """
+    if alpha_grid is None: alpha_grid = np.linspace(0.05, 3, 60)
+    dbh_scaled = np.asarray(dbh_scaled, dtype = float)
+    alpha_grid = np.asarray(alpha_grid, dtype = float)
+    profile_loglik = lambda alpha: get_ssnt_isd_loglik_alphas(dbh_scaled, [alpha])[0][0]
+    loglik_grid = get_ssnt_isd_loglik_alphas(dbh_scaled, alpha_grid)[0]
+    i = np.argmax(loglik_grid)
+    res = optimize.minimize_scalar(lambda alpha: -profile_loglik(alpha), method = 'bounded', 
+                                   bounds = (alpha_grid[max(i - 1, 0)], alpha_grid[min(i + 1, len(alpha_grid) - 1)]))
+    alpha_mle, loglik_max = (res.x, -res.fun) if -res.fun > loglik_grid[i] else (alpha_grid[i], loglik_grid[i])
+    loglik_cut = loglik_max - stats.chi2.ppf(ci_level, 1) / 2
+    below = np.where(loglik_grid < loglik_cut)[0]
+    lower, upper = np.nan, np.nan
+    if np.any(below < i): 
+        j = below[below < i][-1]
+        lower = optimize.brentq(lambda alpha: profile_loglik(alpha) - loglik_cut, alpha_grid[j], alpha_grid[j + 1])
+    if np.any(below > i): 
+        j = below[below > i][0]
+        upper = optimize.brentq(lambda alpha: profile_loglik(alpha) - loglik_cut, alpha_grid[j - 1], alpha_grid[j])
+    return alpha_mle, lower, upper, loglik_max
+
+def get_ssnt_alpha_profile(dat_site_list, alpha_grid = None, in_dir = './data/', out_dir = './out_files/'):
+    """Profile likelihood of alpha in SSNT for each [dat_name, site] in dat_site_list, written to two files.
+    
+    ssnt_alpha_loglik.txt has a header with the values of alpha_grid, then one row per site with the dataset, 
+    the site, and the joint log-likelihood of abundances and diameters (see get_lik_sp_abd_dbh_ssnt_alphas()) 
+    for each alpha. ssnt_alpha_mle.txt has one row per site with the dataset, the site, and the MLE of alpha 
+    with the lower and upper bounds of its 95% confidence interval (see get_ssnt_alpha_mle(), which also gives 
+    the default alpha_grid). Both files are replaced. Sites that do not pass the cleaning (see get_site_data()) 
+    are skipped, as in the driver.
+    
+    """
+    if alpha_grid is None: alpha_grid = np.linspace(0.05, 3, 60)
+    loglik_rows = [' '.join(['dataset', 'site'] + [repr(float(alpha)) for alpha in alpha_grid])]
+    mle_rows = []
+    for dat_name, site in dat_site_list:
+        dat_clean = get_site_data(dat_name, site, in_dir = in_dir)
+        if dat_clean is None: continue
+        lik = get_lik_sp_abd_dbh_ssnt_alphas(dat_clean, alpha_grid)
+        alpha_mle, lower, upper, loglik_max = get_ssnt_alpha_mle(dat_clean['dbh'] / min(dat_clean['dbh']), alpha_grid = alpha_grid)
+        loglik_rows.append(' '.join([dat_name, str(site)] + [repr(x) for x in lik]))
+        mle_rows.append(' '.join([dat_name, str(site), repr(alpha_mle), repr(lower), repr(upper)]))
+    for file_name, rows in [('ssnt_alpha_loglik.txt', loglik_rows), ('ssnt_alpha_mle.txt', mle_rows)]:
+        write_file_atomic(out_dir + file_name, '\n'.join(rows) + '\n')
+
+def evaluate_site(dat_clean, models = ('ssnt_0', 'ssnt_1', 'asne', 'agsne'), patterns = ('SAD', 'ISD', 'SDR', 'lik'), 
+                  dataset_name = None, out_dir = './out_files/', site_idx = None):
+    """Obtain the observed and predicted SAD, ISD, and SDR and the likelihood of a site for several models in one call.
+    
+    The state shared by the models and patterns (site_index, G, S, N, E, scaled diameters, and the observed 
+    values of each pattern) is computed only once, and each output file is written once per pattern and model.
+    Inputs:
+    dat_clean - data for one site in the same format as obtained by clean_data_agsne(), with
+        four columns site, sp, dbh, and genus.
+    models - list of models, from 'ssnt_0', 'ssnt_1', 'asne', and 'agsne'.
+    patterns - list of patterns, from 'SAD', 'ISD', 'SDR', and 'lik'.
+    dataset_name - name of the dataset. If provided, the results are written to out_dir in the same 
+        format as get_obs_pred_sad(), get_obs_pred_isd(), get_obs_pred_sdr(), and (only when all four 
+        models are requested) get_lik_sp_abd_dbh_four_models().
+    out_dir - directory for output files.
+    site_idx - site_index of dat_clean, built here if not provided.
+    Output:
+    Dictionary with keys (pattern, model), with values (obs, pred) for SAD, ISD, and SDR and the summed 
+        log likelihood for 'lik'.
+    
+    """
+    if site_idx is None: site_idx = site_index(dat_clean)
+    G, S, N, E = get_GSNE(dat_clean, site_idx)
+    site = dat_clean['site'][0]
+    dbh_scaled = np.asarray(dat_clean['dbh'] / min(dat_clean['dbh']), dtype = float)
+    out = {}
+    if 'SAD' in patterns:
+        obs = np.sort(site_idx.sp_counts)[::-1]
+        pred_ssnt = None
+        for model in models:
+            if model in ['ssnt_0', 'ssnt_1']:  # The two versions of SSNT share the same SAD
+                if pred_ssnt is None: pred_ssnt = get_pred_sad('ssnt', G, S, N, E)
+                out[('SAD', model)] = (obs, pred_ssnt)
+            else: out[('SAD', model)] = (obs, get_pred_sad(model, G, S, N, E))
+    if 'ISD' in patterns:
+        obs = np.sort(dbh_scaled)
+        for model in models: 
+            out[('ISD', model)] = (obs, get_pred_isd(model, G, S, N, E, dbh_scaled))
+    if 'SDR' in patterns:
+        obs = site_idx.group_mean(dbh_scaled ** 2)
+        for model in models: 
+            out[('SDR', model)] = (obs, get_pred_sdr(model, G, S, N, E, dbh_scaled, site_idx))
+    if 'lik' in patterns:
+        with profile_stage('likelihood'):
+            lik = get_lik_sp_abd_dbh_community(dat_clean, site_idx = site_idx, models = models)
+        for model in models: out[('lik', model)] = lik[model]
+    
+    if dataset_name is not None:
+        for (pattern, model), val in sorted(out.items()):
+            if pattern == 'lik': continue
+            write_obs_pred(val[0], val[1], dataset_name, site, pattern.lower().replace('sad', 'rad'), model, out_dir = out_dir, 
+                           dtype = 'S15, i8, i8' if pattern == 'SAD' else 'S15, f8, f8')
+        if 'lik' in patterns and set(['asne', 'agsne', 'ssnt_0', 'ssnt_1']) <= set(models):
+            get_result_sink().write(out_dir + 'lik_sp_abd_dbh_four_models.txt', 
+                                    ' '.join([dataset_name, str(site)] + [str(lik[model]) for model in ['asne', 'agsne', 'ssnt_0', 'ssnt_1']]) + '\n')
+    return out
+
+def get_provenance_path(dat_name, site, out_dir = './out_files/'):
+    """Path of the file with the provenance hashes of the obs_pred outputs and likelihood of a site (see update_site())."""
+    return out_dir + 'provenance/' + dat_name + '_' + str(site) + '.json'
+
+def update_site(dat_name, site, models = ('ssnt_0', 'ssnt_1', 'asne', 'agsne'), patterns = ('SAD', 'ISD', 'SDR', 'lik'), 
+                in_dir = './data/', out_dir = './out_files/'):
+    """Write the outputs of evaluate_site() for a site only if they are missing or stale.
+    
+    Each output (obs_pred values of a pattern and model, and the likelihood row) is recorded with 
+    its provenance hash (see get_input_hash()) in the file of get_provenance_path(). If any of them 
+    is missing (including its rows in the output file, or the site in the results store) or was computed from other 
+    site data or with another analysis_version, the site is evaluated again and its rows in the output 
+    files are replaced. The provenance is only recorded once the rows are written (see queue_sink.flush()). 
+    The site is checked and updated under a lock file, so that the task is idempotent even when several 
+    processes run it at once. Returns True if the site was evaluated. Sites that do not pass the cleaning 
+    (see get_site_data()) are skipped, as in the driver, and False is returned.
+    
+    """
+    dat_clean = get_site_data(dat_name, site, in_dir = in_dir)
+    if dat_clean is None: return False
+    site_hash = get_site_hash(dat_clean)
+    keys = [pattern.lower().replace('sad', 'rad') + '_' + model for pattern in patterns if pattern != 'lik' for model in models]
+    if 'lik' in patterns and set(['asne', 'agsne', 'ssnt_0', 'ssnt_1']) <= set(models): keys.append('lik')
+    hashes = dict((key, get_input_hash(site_hash, key)) for key in keys)
+    provenance_path = get_provenance_path(dat_name, site, out_dir = out_dir)
+    output_rows = dict((key, (out_dir + dat_name + '_obs_pred_' + key + '.csv', [str(site)[:15]], ',')) # Site is written as S15
+                       for key in keys if key != 'lik')
+    if 'lik' in keys: output_rows['lik'] = (out_dir + 'lik_sp_abd_dbh_four_models.txt', [dat_name, site], ' ')
+    if not os.path.isdir(os.path.dirname(provenance_path)):
+        try: os.makedirs(os.path.dirname(provenance_path))
+        except OSError: pass
+    with open(provenance_path[:-len('.json')] + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try: 
+            with open(provenance_path) as f:
+                recorded = json.load(f)
+        except (IOError, ValueError): recorded = {}
+        get_result_sink().flush()
+        outputs_exist = all([has_site_rows(*output_rows[key]) for key in keys]) and \
+            all([(dat_name, str(site)) in get_obs_pred_store(*key.split('_', 1), out_dir = out_dir).offsets for key in keys if key != 'lik'])
+        if outputs_exist and all([recorded.get(key) == hashes[key] for key in keys]): return False
+        
+        for key in keys:
+            remove_site_rows(*output_rows[key])
+        evaluate_site(dat_clean, models = models, patterns = patterns, dataset_name = dat_name, out_dir = out_dir)
+        get_result_sink().flush()
+        recorded.update(hashes)
+        write_file_atomic(provenance_path, json.dumps(recorded, sort_keys = True))
+    return True
 
 def plot_likelihood_comp(lik_dir = './out_files/', out_fig_dir = './out_figs/'):
     """Plot the likelihood of the other three models against ASNE."""
@@ -407,8 +1481,13 @@ def plot_likelihood_comp(lik_dir = './out_files/', out_fig_dir = './out_figs/'):
     ax.legend(loc = 2, prop = {'size': 8})
     plt.savefig(out_fig_dir + 'lik_comp.png', dpi = 400)
 
-def plot_r2_comp(name_site_combo, dat_dir = './out_files/', out_fig_dir = './out_figs/'):
-    """Plot r2 of the three patterns separately for each community."""
+def plot_r2_comp(name_site_combo, dat_dir = './out_files/', out_fig_dir = './out_figs/', cache = None):
+    """Plot r2 of the three patterns separately for each community.
+    
+    cache - results_cache for dat_dir, created here if not provided
+    
+    """
+    if cache is None: cache = results_cache(dat_dir)
     models = ['asne', 'agsne', 'ssnt_0', 'ssnt_1']
     model_names = ['ASNE', 'AGSNE', 'SSNT_N', 'SSNT_M']
     patterns = ['rad', 'isd', 'sdr']
@@ -418,15 +1497,10 @@ def plot_r2_comp(name_site_combo, dat_dir = './out_files/', out_fig_dir = './out
     
     fig = plt.figure(figsize = (10.5, 3.5))
     for i, pattern in enumerate(patterns):
-        r2_dic = {'asne':[], 'agsne':[], 'ssnt_0':[], 'ssnt_1':[]}
-        r2_list = []
+        r2_dic = {}
         for j, model in enumerate(models):
-            for dat_name, site in name_site_combo:
-                pred_obs_model_pattern = wk.import_obs_pred_data(dat_dir + dat_name + '_obs_pred_' + pattern + '_' + model + '.csv')
-                pred_obs_site = pred_obs_model_pattern[pred_obs_model_pattern['site'] == site]
-                r2 = mtools.obs_pred_rsquare(np.log10(pred_obs_site['obs']), np.log10(pred_obs_site['pred']))
-                r2_dic[model].append(r2)
-                r2_list.append(r2)
+            r2_dic[model] = cache.get_rsquare(name_site_combo, pattern, model)
+        r2_list = np.concatenate([r2_dic[model] for model in models])
         
         ax = plt.subplot(1, 3, i + 1)
         for j in range(1, 4):
@@ -451,200 +1525,595 @@ def plot_r2_comp(name_site_combo, dat_dir = './out_files/', out_fig_dir = './out
     plt.tight_layout()
     plt.savefig(out_fig_dir + 'r2_comp.png', dpi = 400)  
          
-def bootstrap_SAD(name_site_combo, model, in_dir = './data/', out_dir = './out_files/', Niter = 200):
+def get_pattern_dist(pattern, model, raw_data_site, site_idx = None):
+    """Distribution predicted by a model for a pattern, as sampled in the bootstrap analyses.
+    
+    Inputs:
+    pattern - 'SAD', 'ISD' (the distribution of D for SSNT, or of D^2 for ASNE and AGSNE) or 
+        'SDR' (the distribution within species of D for SSNT, or of D^2 for ASNE and AGSNE)
+    model - one of 'ssnt_0', 'ssnt_1', 'asne', or 'agsne'
+    raw_data_site - cleaned data for one site, as returned by clean_data_agsne()
+    site_idx - optional site_index of raw_data_site
+    
+    """
+    G, S, N, E = get_GSNE(raw_data_site, site_idx)
+    if pattern == 'SAD':
+        if model in ['ssnt_0', 'ssnt_1']: return stats.logser(np.exp(-get_beta_cached(S, N, version = 'untruncated')))
+        elif model == 'asne': return md.trunc_logser(np.exp(-get_beta_cached(S, N)), N)
+        else: return mete_distributions.sad_agsne([G, S, N, E], get_agsne_pars(G, S, N, E))
+    if model in ['ssnt_0', 'ssnt_1']: # The SSNT ISD is also the distribution within species
+        alpha = ssnt_alpha[model]
+        dbh_scaled = np.asarray(raw_data_site['dbh'] / min(raw_data_site['dbh']), dtype = float)
+        return ssnt_isd_bounded(alpha, N / (np.sum(dbh_scaled ** alpha) - N))
+    if pattern == 'ISD':
+        if model == 'asne': return mete_distributions.psi_epsilon_approx(S, N, E)
+        else: return mete_distributions.psi_agsne([G, S, N, E], get_agsne_pars(G, S, N, E))
+    else:
+        if model == 'asne': return mete_distributions.theta_epsilon(S, N, E)
+        else: return mete_distributions.theta_agsne([G, S, N, E], get_agsne_pars(G, S, N, E))
+
+def get_bootstrap_unit_path(out_dir, pattern, model, dat_name, site):
+    """Path of the checkpoint file for one (dataset, site, model, pattern) bootstrap unit."""
+    return out_dir + 'bootstrap_units/' + '_'.join([pattern, model, dat_name, str(site)]) + '.json'
+
+def get_shard_path(unit_path, shard):
+    """Path of the checkpoint file for one shard of a bootstrap unit (see run_bootstrap_unit())."""
+    return unit_path[:-len('.json')] + '_shard' + str(shard) + '.json'
+
+def remove_stale_shards(unit_path, num_shards):
+    """Remove the shard files of a unit (see get_shard_path()) left by an earlier run with more than num_shards shards."""
+    unit_dir, unit_file = os.path.split(unit_path)
+    if not os.path.isdir(unit_dir): return
+    prefix = unit_file[:-len('.json')] + '_shard'
+    for shard_file in os.listdir(unit_dir):
+        if shard_file.startswith(prefix) and shard_file.endswith('.json') and \
+            int(shard_file[len(prefix):-len('.json')]) >= num_shards:
+            try: os.remove(os.path.join(unit_dir, shard_file))
+            except OSError: pass # Already removed by another shard
+
+def get_bootstrap_hash(dat_clean, pattern, model, checkpoint_every):
+    """Provenance hash of a bootstrap unit (see get_input_hash()), which also depends on the random streams of its samples."""
+    return get_input_hash(get_site_hash(dat_clean), 'bootstrap', pattern, model, bootstrap_seed, checkpoint_every)
+
+def seed_bootstrap_block(unit, first_iter):
+    """Seed the global numpy random number generator for the block of samples of a unit starting at sample first_iter.
+    
+    The seed is a 128-bit hash of bootstrap_seed, the dataset, site, pattern, and model of the unit, and first_iter, 
+    so that each block has its own independent stream regardless of which process draws it, or in which order. 
+    The global generator is used as it is the one behind the rvs() methods of all the distributions. 
+    Nothing is done if bootstrap_seed is None.
+    
+    """
+    if bootstrap_seed is None: return
+    key = '_'.join([str(bootstrap_seed), unit['dataset'], str(unit['site']), unit['pattern'], unit['model'], str(first_iter)])
+    np.random.seed(np.frombuffer(hashlib.md5(key).digest(), dtype = '<u4'))
+
+def load_bootstrap_unit(unit_path, input_hash = None):
+    """Load a checkpointed bootstrap unit, returning None if it does not exist or cannot be read, 
+    
+    or, if input_hash is given, if the unit has another 'input_hash' (i.e., it was computed from 
+    other data, code, or parameters, see get_input_hash()), so that it is drawn again.
+    
+    """
+    try:
+        with open(unit_path) as f:
+            unit = json.load(f)
+    except (IOError, ValueError): return None
+    if input_hash is not None and unit.get('input_hash') != input_hash: return None
+    return unit
+
+def get_unit_quantile_ci(unit, stat, ci_level = 0.95):
+    """Quantile of the observed statistic among the samples of a unit, as computed in plot_hist_quan(), 
+    
+    and its Clopper-Pearson confidence interval. The quantile is the proportion of samples with a 
+    lower R^2 for 'rsquare', and with a larger statistic for the other statistics (e.g. 'ks'). 
+    Both are computed as for the merged results (see boot_summary.get_quantile_ci()).
+    Returns (quantile, lower, upper).
+    
+    """
+    samples = np.array([unit['samples'][stat]], dtype = float)
+    num_closer, num_samples = boot_summary.get_quantile_counts(np.array([unit['orig'][stat]]), samples, 
+                                                               dat_type = 'r2' if stat == 'rsquare' else stat)
+    lower, upper = boot_summary.get_quantile_ci(num_closer, num_samples, ci_level = ci_level)
+    return num_closer[0] / num_samples[0], lower[0], upper[0]
+
+def is_unit_quantile_precise(unit, ci_width, min_iter = 50, ci_level = 0.95, edge = 0.1):
+    """Whether the quantiles of all statistics of a unit are known well enough to stop sampling.
+    
+    That is, after at least min_iter samples, the confidence interval of each quantile (see 
+    get_unit_quantile_ci()) is narrower than ci_width, or lies within edge of zero or one.
+    
+    """
+    if min([len(x) for x in unit['samples'].values()]) < max(min_iter, 1): return False
+    for stat in unit['samples']:
+        quantile, lower, upper = get_unit_quantile_ci(unit, stat, ci_level = ci_level)
+        if upper - lower > ci_width and upper > edge and lower < 1 - edge: return False
+    return True
+
+def is_bootstrap_unit_complete(unit, Niter = None, ci_width = None, min_iter = 50):
+    """Whether a unit has all its samples, i.e., Niter or the Niter it was started with, 
+    
+    or, in the sequential mode (ci_width not None), quantiles that are precise enough 
+    (see is_unit_quantile_precise()). If Niter is None, the settings the unit was run with are used.
+    
+    """
+    if Niter is None: Niter, ci_width, min_iter = unit['Niter'], unit.get('ci_width'), unit.get('min_iter', min_iter)
+    if min([len(x) for x in unit['samples'].values()]) >= Niter: return True
+    return ci_width is not None and is_unit_quantile_precise(unit, ci_width, min_iter = min_iter)
+
+def run_bootstrap_unit(unit_path, unit, Niter, sampler, checkpoint_every = 50, ci_width = None, min_iter = 50, 
+                       shard = None, num_shards = 1):
+    """Draw bootstrap samples for one unit until it has Niter of them, checkpointing along the way.
+    
+    Inputs:
+    unit_path - checkpoint file, rewritten atomically every checkpoint_every samples
+    unit - dict with 'dataset', 'site', 'pattern', 'model', 'input_hash' (see get_bootstrap_hash()), 
+        'orig' (the observed statistics) and 'samples' (the statistics of samples so far), the latter 
+        two keyed by statistic, as returned by load_bootstrap_unit() for a partly finished unit
+    Niter - number of bootstrap samples
+    sampler - function taking the number of samples to draw and returning a dict with the 
+        statistics of each new sample, keyed by statistic
+    ci_width - if not None, sampling stops early once the quantiles of the observed statistics 
+        are precise enough (see is_unit_quantile_precise()), checked at every checkpoint
+    min_iter - minimal number of samples before stopping early
+    shard, num_shards - to split the samples over processes, only draw shard (one of 0, ..., num_shards - 1) 
+        of the samples, checkpointed to its own file (see get_shard_path()); the shards are combined 
+        into the unit by combine_bootstrap_shards(). A shard file drawn with another num_shards or Niter 
+        is drawn again, and those of shards beyond num_shards are removed. Cannot be used with ci_width.
+    
+    The samples are drawn in blocks of checkpoint_every, each from its own random stream (see 
+    seed_bootstrap_block()), so that they do not depend on how the unit is split over shards, 
+    or on whether it is interrupted and resumed. The number of samples drawn is recorded in 
+    the unit as 'Niter_used'.
+    
+    """
+    if shard is not None:
+        if ci_width is not None: raise ValueError('The sequential bootstrap (ci_width) cannot be split over shards.')
+        iter_per_shard = -(-Niter // (checkpoint_every * num_shards)) * checkpoint_every
+        first_iter = min(Niter, shard * iter_per_shard)
+        remove_stale_shards(unit_path, num_shards)
+        unit_path = get_shard_path(unit_path, shard)
+        shard_unit = load_bootstrap_unit(unit_path, input_hash = unit.get('input_hash'))
+        if shard_unit is not None and [shard_unit.get(key) for key in ['num_shards', 'first_iter', 'Niter']] != \
+            [num_shards, first_iter, min(Niter - first_iter, iter_per_shard)]: 
+            shard_unit = None # Drawn with another split of the unit, so it is drawn again
+        if shard_unit is None:
+            shard_unit = dict(unit, samples = dict((stat, []) for stat in unit['samples']), 
+                              shard = shard, num_shards = num_shards, first_iter = first_iter)
+            shard_unit['Niter'] = min(Niter - first_iter, iter_per_shard)
+            write_file_atomic(unit_path, json.dumps(shard_unit)) # Written even if empty, for combine_bootstrap_shards()
+        unit, Niter = shard_unit, min(Niter - first_iter, iter_per_shard)
+    unit['Niter'], unit['ci_width'], unit['min_iter'] = Niter, ci_width, min_iter
+    num_done = min([len(x) for x in unit['samples'].values()])
+    if num_done < Niter: # A last block cut short by a smaller Niter is drawn again in full
+        num_done -= (unit.get('first_iter', 0) + num_done) % checkpoint_every
+    for stat in unit['samples']: 
+        unit['samples'][stat] = unit['samples'][stat][:num_done]
+    while not is_bootstrap_unit_complete(unit, Niter, ci_width = ci_width, min_iter = min_iter):
+        block_start = unit.get('first_iter', 0) + num_done
+        num_new = min(checkpoint_every - block_start % checkpoint_every, Niter - num_done)
+        seed_bootstrap_block(unit, block_start)
+        stats_new = sampler(num_new)
+        profile_count('bootstrap_samples', num_new)
+        for stat in unit['samples']:
+            unit['samples'][stat] = unit['samples'][stat] + [float(x) for x in stats_new[stat]]
+        num_done += num_new
+        unit['Niter_used'] = num_done
+        write_file_atomic(unit_path, json.dumps(unit))
+
+def combine_bootstrap_shards(unit_dir, pattern = None, model = None):
+    """Combine the shards of each bootstrap unit in unit_dir (see run_bootstrap_unit()) into the unit file, 
+    
+    once all of them are complete, and remove the shard files. The samples are ordered as in an 
+    unsharded run, which they equal exactly. If pattern and model are given, only their units are combined. 
+    Raises ValueError if the complete shards of a unit do not make up one split of it, e.g. 
+    when some were drawn with another num_shards and not drawn again.
+    
+    """
+    prefix = '' if pattern is None else pattern + '_' + model + '_'
+    shard_files = {}
+    for unit_file in sorted(os.listdir(unit_dir)):
+        if unit_file.endswith('.json') and '_shard' in unit_file and unit_file.startswith(prefix):
+            shard_files.setdefault(unit_file[:-len('.json')].rsplit('_shard', 1)[0], []).append(unit_dir + unit_file)
+    for unit_name, file_list in shard_files.items():
+        shards = [load_bootstrap_unit(shard_file) for shard_file in file_list]
+        if any([shard is None or not is_bootstrap_unit_complete(shard) for shard in shards]): continue
+        shards.sort(key = lambda shard: shard['first_iter'])
+        if [shard['shard'] for shard in shards] != range(shards[0]['num_shards']) or \
+            len(set([(shard['num_shards'], shard['input_hash']) for shard in shards])) > 1 or \
+            any([shard['first_iter'] != sum([x['Niter'] for x in shards[:i]]) for i, shard in enumerate(shards)]):
+            raise ValueError('The shards of bootstrap unit ' + unit_name + ' were drawn with different splits of the unit, ' + 
+                             'run its bootstrap again to redraw them.')
+        unit = dict((key, value) for key, value in shards[0].items() if key not in ['shard', 'num_shards', 'first_iter'])
+        for stat in unit['samples']:
+            unit['samples'][stat] = sum([shard['samples'][stat][:shard['Niter']] for shard in shards], [])
+        unit['Niter'] = unit['Niter_used'] = sum([shard['Niter'] for shard in shards])
+        write_file_atomic(unit_dir + unit_name + '.json', json.dumps(unit))
+        for shard_file in file_list:
+            os.remove(shard_file)
+
+def merge_bootstrap_units(pattern, model, out_dir = './out_files/'):
+    """Write the complete bootstrap units of a pattern and model to the combined bootstrap files.
+    
+    One file is written for each statistic, e.g. SAD_bootstrap_asne_rsquare.txt, with one row per site 
+    (dataset, site, observed statistic, sampled statistics) as read by import_bootstrap_file_incomp(). 
+    The same values are also added to the results store (see import_bootstrap_store()), tagged with the 
+    input_hash of the unit so that only new or recomputed units are added, and summarized by site 
+    in a table (see get_bootstrap_summary_path() and boot_summary.summarize_bootstrap()). 
+    Units run in shards are first combined with combine_bootstrap_shards().
+    
+    """
+    unit_dir = out_dir + 'bootstrap_units/'
+    if not os.path.isdir(unit_dir): return
+    combine_bootstrap_shards(unit_dir, pattern = pattern, model = model)
+    rows = {}
+    for unit_file in sorted(os.listdir(unit_dir)):
+        if not unit_file.endswith('.json'): continue
+        unit = load_bootstrap_unit(unit_dir + unit_file)
+        if unit is None or unit['pattern'] != pattern or unit['model'] != model or 'shard' in unit: continue
+        if not is_bootstrap_unit_complete(unit): continue
+        for stat in unit['samples']:
+            row = [unit['dataset'], unit['site'], repr(unit['orig'][stat])] + [repr(x) for x in unit['samples'][stat][:unit['Niter']]]
+            rows.setdefault(stat, []).append(",".join(row))
+            values = [unit['orig'][stat]] + unit['samples'][stat][:unit['Niter']]
+            store = get_bootstrap_store(pattern, model, stat, out_dir = out_dir)
+            tag = unit.get('input_hash', '') + '_' + str(len(values))
+            if store.tags.get((unit['dataset'], unit['site'])) != tag: 
+                store.append(unit['dataset'], unit['site'], tag = tag, value = values)
+    for stat in rows:
+        boot_file = out_dir + pattern + '_bootstrap_' + model + '_' + stat + '.txt'
+        write_file_atomic(boot_file, '\n'.join(rows[stat]) + '\n')
+        summary = boot_summary.summarize_bootstrap(*boot_summary.load_bootstrap_matrix(boot_file), 
+                                                   dat_type = 'r2' if stat == 'rsquare' else 'ks')
+        write_file_atomic(get_bootstrap_summary_path(pattern, model, stat, out_dir = out_dir), boot_summary.format_summary_table(summary))
+
+def get_cdf_lookup(dist, values):
+    """Evaluate dist.cdf on an array of values of any shape, calling it once per distinct value."""
+    values = np.asarray(values)
+    uniq_values, inv = np.unique(values, return_inverse = True)
+    cdf_table = np.array([dist.cdf(x) for x in uniq_values], dtype = float).ravel()
+    return cdf_table[inv].reshape(values.shape)
+
+def get_emp_cdf_rows(x_sorted):
+    """Row-wise version of mtools.get_emp_cdf() for a 2-D array with each row sorted in increasing order."""
+    x_sorted = np.asarray(x_sorted)
+    num_col = x_sorted.shape[1]
+    # For each value, find the position of the last value in the row equal to it
+    is_last = np.ones(x_sorted.shape, dtype = bool)
+    is_last[:, :-1] = x_sorted[:, 1:] != x_sorted[:, :-1]
+    last_pos = np.where(is_last, np.arange(num_col), num_col)
+    last_pos = np.minimum.accumulate(last_pos[:, ::-1], axis = 1)[:, ::-1]
+    return (last_pos + 1) / num_col
+
+def obs_pred_rsquare_rows(obs, pred):
+    """Row-wise version of mtools.obs_pred_rsquare(), with obs a 2-D array and pred shared by all rows."""
+    return 1 - np.sum((obs - pred) ** 2, axis = 1) / np.sum((obs - np.mean(obs, axis = 1)[:, None]) ** 2, axis = 1)
+
+def obs_pred_rsquare_groups(obs, pred, lengths):
+    """Version of mtools.obs_pred_rsquare() for consecutive groups of values (e.g. sites) with the given lengths,
+    
+    returning one R^2 per group, computed with group reductions over the concatenated values.
+    
+    """
+    lengths = np.asarray(lengths)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    obs_mean = np.add.reduceat(obs, starts) / lengths
+    ss_res = np.add.reduceat((obs - pred) ** 2, starts)
+    ss_tot = np.add.reduceat((obs - np.repeat(obs_mean, lengths)) ** 2, starts)
+    return 1 - ss_res / ss_tot
+
+def get_sad_bootstrap_stats(dist, pred, Niter):
+    """R^2 and K-S statistic of Niter samples from the SAD dist, computed in matrix form.
+    
+    Inputs:
+    dist - SAD of any of the four models, with methods rvs() and cdf()
+    pred - predicted abundances in increasing order, one per species
+    Niter - number of bootstrap samples
+    
+    Output:
+    Two arrays of length Niter with R^2 and the K-S statistic of each sample.
+    
+    """
+    S = len(pred)
+    with profile_stage('sample'):
+        obs_boot = np.sort(np.reshape(dist.rvs(Niter * S), (Niter, S)), axis = 1)
+    with profile_stage('statistic'):
+        cdf_boot = get_cdf_lookup(dist, obs_boot)
+        emp_cdf_boot = get_emp_cdf_rows(obs_boot)
+        rsquare = obs_pred_rsquare_rows(np.log10(obs_boot), np.log10(pred))
+        ks = np.max(np.abs(emp_cdf_boot - cdf_boot), axis = 1)
+    return rsquare, ks
+
+def bootstrap_SAD(name_site_combo, model, in_dir = './data/', out_dir = './out_files/', Niter = 200, checkpoint_every = 50, 
+                  ci_width = None, min_iter = 50, shard = None, num_shards = 1):
     """A general function of bootstrapping for SAD applying to all four models. 
     
     Inputs:
     name_site_combo: a list with dat_name and site
     model - takes one of four values 'ssnt_0', 'ssnt_1', 'asne', or 'agsne'
-    in_dir - directory of raw data
+    in_dir - directory of raw data, cleaned and cached on first use by ingest_raw_data()
     out_dir - directory used both in input (obs_pred.csv file) and output 
     Niter - number of bootstrap samples
+    checkpoint_every - number of samples between checkpoints
+    ci_width, min_iter - settings of the sequential mode, which stops early once the quantiles of the 
+        observed statistics are precise enough (see run_bootstrap_unit())
+    shard, num_shards - only draw one of num_shards parts of the samples (see run_bootstrap_unit())
     
     Output:
-    Writes to disk, with one file for R^2 and one for KS statistic.
+    Writes to disk one checkpoint file for the site, with R^2 and KS statistic, which is 
+    skipped if already complete and resumed if partly finished, unless the site data or the 
+    analyses have changed since (see get_bootstrap_hash()). See merge_bootstrap_units() for the combined output.
     
     """
     dat_name, site = name_site_combo
-    dat = wk.import_raw_data(in_dir + dat_name + '.csv')
-    dat_site = dat[dat['site'] == site]
-    dat_clean = clean_data_agsne(dat_site)    
-    G, S, N, E = get_GSNE(dat_clean)
-    beta_ssnt = mete.get_beta(S, N, version = 'untruncated')
-    beta_asne = mete.get_beta(S, N)
-    lambda1, beta, lambda3 = agsne.get_agsne_lambdas(G, S, N, E)
-    sad_agsne = mete_distributions.sad_agsne([G, S, N, E], [lambda1, beta, lambda3, agsne.agsne_lambda3_z(lambda1, beta, S) / lambda3])
-    dist_for_model = {'ssnt_0': stats.logser(np.exp(-beta_ssnt)), 
-                      'ssnt_1': stats.logser(np.exp(-beta_ssnt)), 
-                      'asne': md.trunc_logser(np.exp(-beta_asne), N),
-                      'agsne': sad_agsne}
-    dist = dist_for_model[model]
-    pred_obs = wk.import_obs_pred_data(out_dir + dat_name + '_obs_pred_rad_' + model + '.csv')
-    pred = pred_obs[pred_obs['site'] == site]['pred'][::-1]
-    obs = pred_obs[pred_obs['site'] == site]['obs'][::-1]
-    
-    out_list_rsquare = [dat_name, site, str(mtools.obs_pred_rsquare(np.log10(obs), np.log10(pred)))]
-    emp_cdf = mtools.get_emp_cdf(obs)
-    out_list_ks = [dat_name, site, str(max(abs(emp_cdf - np.array([dist.cdf(x) for x in obs]))))]
+    unit_path = get_bootstrap_unit_path(out_dir, 'SAD', model, dat_name, site)
+    dat_clean = get_site_data(dat_name, site, in_dir = in_dir)
+    input_hash = get_bootstrap_hash(dat_clean, 'SAD', model, checkpoint_every)
+    unit = load_bootstrap_unit(unit_path, input_hash = input_hash)
+    if unit is not None and is_bootstrap_unit_complete(unit, Niter, ci_width = ci_width, min_iter = min_iter): return
+    dist = get_pattern_dist('SAD', model, dat_clean)
+    obs, pred = get_obs_pred_site(dat_name, site, 'rad', model, out_dir = out_dir)
+    obs, pred = obs[::-1], pred[::-1]
+    
+    if unit is None:
+        emp_cdf = mtools.get_emp_cdf(obs)
+        unit = {'dataset': dat_name, 'site': str(site), 'pattern': 'SAD', 'model': model, 'input_hash': input_hash, 
+                'orig': {'rsquare': float(mtools.obs_pred_rsquare(np.log10(obs), np.log10(pred))), 
+                         'ks': float(max(abs(emp_cdf - get_cdf_lookup(dist, obs))))}, 
+                'samples': {'rsquare': [], 'ks': []}}
+    
+    def sampler(num_new):
+        rsquare_boot, ks_boot = get_sad_bootstrap_stats(dist, pred, num_new)
+        return {'rsquare': rsquare_boot, 'ks': ks_boot}
+    run_bootstrap_unit(unit_path, unit, Niter, sampler, checkpoint_every = checkpoint_every, 
+                       ci_width = ci_width, min_iter = min_iter, shard = shard, num_shards = num_shards)
+
+def get_worker_pool():
+    """Return the long-lived worker pool with core_budget processes, creating it on first use.
+    
+    Returns None inside a daemonic pool worker, which cannot have children, so that 
+    callers fall back to running in-process.
     
-    for i in range(Niter):
-        obs_boot = np.array(sorted(dist.rvs(S)))
-        cdf_boot = np.array([dist.cdf(x) for x in obs_boot])
-        emp_cdf_boot = mtools.get_emp_cdf(obs_boot)
-        out_list_rsquare.append(str(mtools.obs_pred_rsquare(np.log10(obs_boot), np.log10(pred))))
-        out_list_ks.append(str(max(abs(emp_cdf_boot - np.array(cdf_boot)))))
+    """
+    global _worker_pool
+    if multiprocessing.current_process().daemon: return None
+    if _worker_pool is None: 
+        _worker_pool = multiprocessing.Pool(core_budget)
+    return _worker_pool
+
+def generate_isd_sample(dist_size_seed):
+    """Draw a batch of random values from an ISD, returning the cdf and the values.
+    
+    Input is a tuple (dist, size, seed) so that batches can be mapped over a pool; 
+    each batch reseeds the RNG, so that forked workers do not repeat each other's draws.
+    
+    """
+    dist, size, seed = dist_size_seed
+    np.random.seed(seed)
+    sample = np.asarray(dist.rvs(size), dtype = float)
+    if isinstance(dist, ssnt_isd_bounded): cdf = dist.cdf(sample)
+    else: cdf = np.array([dist.cdf(x) for x in sample])
+    return cdf, sample
+
+def get_isd_bootstrap_samples(dist, N, Niter, pool = None, batch_size = 100000):
+    """Generator yielding Niter (cdf, sample) pairs, each with N random values from dist.
     
-    wk.write_to_file(out_dir + 'SAD_bootstrap_' + model + '_rsquare.txt', ",".join(str(x) for x in out_list_rsquare))
-    wk.write_to_file(out_dir + 'SAD_bootstrap_' + model + '_ks.txt', ",".join(str(x) for x in out_list_ks))
+    Exactly N * Niter values are drawn in batches of at most batch_size, which are 
+    spread over pool (any object with an imap or map method, e.g. the one from 
+    get_worker_pool()) or drawn in-process if pool is None.
+    
+    """
+    num_total = N * Niter
+    sizes = [min(batch_size, num_total - start) for start in xrange(0, num_total, batch_size)]
+    seeds = np.random.randint(0, 2 ** 31 - 1, size = len(sizes))
+    tasks = [(dist, size, seed) for size, seed in zip(sizes, seeds)]
+    if pool is None: batches = (generate_isd_sample(task) for task in tasks)
+    else: batches = getattr(pool, 'imap', pool.map)(generate_isd_sample, tasks)
+    
+    cdf_buffer, sample_buffer, num_buffered = [], [], 0
+    for cdf_batch, sample_batch in batches:
+        cdf_buffer.append(cdf_batch)
+        sample_buffer.append(sample_batch)
+        num_buffered += len(sample_batch)
+        if num_buffered >= N:
+            cdf_all, sample_all = np.concatenate(cdf_buffer), np.concatenate(sample_buffer)
+            num_iter = num_buffered // N
+            for i in xrange(num_iter):
+                yield cdf_all[i * N: (i + 1) * N], sample_all[i * N: (i + 1) * N]
+            cdf_buffer, sample_buffer = [cdf_all[num_iter * N:]], [sample_all[num_iter * N:]]
+            num_buffered -= num_iter * N
 
-def bootstrap_ISD(name_site_combo, model, in_dir = './data/', out_dir = './out_files/', Niter = 200):
+def bootstrap_ISD(name_site_combo, model, in_dir = './data/', out_dir = './out_files/', Niter = 200, pool = 'default', 
+                  checkpoint_every = 50, ci_width = None, min_iter = 50, shard = None, num_shards = 1):
     """A general function of bootstrapping for ISD applying to all four models. 
     
     Inputs:
     name_site_combo: a list with dat_name and site
     model - takes one of four values 'ssnt_0', 'ssnt_1', 'asne', or 'agsne'
-    in_dir - directory of raw data
+    in_dir - directory of raw data, cleaned and cached on first use by ingest_raw_data()
     out_dir - directory used both in input (obs_pred.csv file) and output 
     Niter - number of bootstrap samples
+    pool - pool or executor used to draw the samples; by default the long-lived pool 
+        from get_worker_pool(), and None to draw them in-process
+    checkpoint_every - number of samples between checkpoints
+    ci_width, min_iter - settings of the sequential mode, which stops early once the quantiles of the 
+        observed statistics are precise enough (see run_bootstrap_unit())
+    shard, num_shards - only draw one of num_shards parts of the samples (see run_bootstrap_unit())
     
     Output:
-    Writes to disk, with one file for R^2 and one for KS statistic.
+    Writes to disk one checkpoint file for the site, with R^2 and KS statistic, which is 
+    skipped if already complete and resumed if partly finished, unless the site data or the 
+    analyses have changed since (see get_bootstrap_hash()). See merge_bootstrap_units() for the combined output.
     
     """
     dat_name, site = name_site_combo
-    dat = wk.import_raw_data(in_dir + dat_name + '.csv')
-    dat_site = dat[dat['site'] == site]
-    dat_clean = clean_data_agsne(dat_site)    
+    unit_path = get_bootstrap_unit_path(out_dir, 'ISD', model, dat_name, site)
+    dat_clean = get_site_data(dat_name, site, in_dir = in_dir)
+    input_hash = get_bootstrap_hash(dat_clean, 'ISD', model, checkpoint_every)
+    unit = load_bootstrap_unit(unit_path, input_hash = input_hash)
+    if unit is not None and is_bootstrap_unit_complete(unit, Niter, ci_width = ci_width, min_iter = min_iter): return
+    if pool == 'default': pool = get_worker_pool()
     G, S, N, E = get_GSNE(dat_clean)
-    lambda1, beta, lambda3 = agsne.get_agsne_lambdas(G, S, N, E)
-    isd_agsne = mete_distributions.psi_agsne([G, S, N, E], [lambda1, beta, lambda3, agsne.agsne_lambda3_z(lambda1, beta, S) / lambda3])
-    isd_asne = mete_distributions.psi_epsilon_approx(S, N, E)
-    dbh_scaled = np.array(dat_clean['dbh'] / min(dat_clean['dbh']))
-    isd_ssnt_0 = ssnt_isd_bounded(1, N / (sum(dbh_scaled ** 1) - N))
-    isd_ssnt_1 = ssnt_isd_bounded(2/3, N / (sum(dbh_scaled ** (2/3)) - N))
-    dist_for_model = {'ssnt_0': isd_ssnt_0, 'ssnt_1': isd_ssnt_1, 'asne': isd_asne, 'agsne': isd_agsne}
-    dist = dist_for_model[model]
-    pred_obs = wk.import_obs_pred_data(out_dir + dat_name + '_obs_pred_isd_' + model + '.csv')
-    pred = pred_obs[pred_obs['site'] == site]['pred']
-    obs = pred_obs[pred_obs['site'] == site]['obs']
-    
-    out_list_rsquare = [dat_name, site, str(mtools.obs_pred_rsquare(np.log10(obs), np.log10(pred)))]
-    wk.write_to_file(out_dir + 'ISD_bootstrap_' + model + '_rsquare.txt', ",".join(str(x) for x in out_list_rsquare), new_line = False)
+    dist = get_pattern_dist('ISD', model, dat_clean)
+    obs, pred = get_obs_pred_site(dat_name, site, 'isd', model, out_dir = out_dir)
+    
     emp_cdf = mtools.get_emp_cdf(obs)
-    out_list_ks = [dat_name, site, str(max(abs(emp_cdf - np.array([dist.cdf(x) for x in obs]))))]
-    wk.write_to_file(out_dir + 'ISD_bootstrap_' + model + '_ks.txt', ",".join(str(x) for x in out_list_ks), new_line = False)
-    
-    num_pools = 8  # Assuming that 8 pools are to be created
-    for i in xrange(Niter):
-        obs_boot = []
-        cdf_boot = []
-        while len(obs_boot) < N:
-            pool = multiprocessing.Pool(num_pools)
-            out_sample = pool.map(wk.generate_isd_sample, [dist for j in xrange(num_pools)])
-            for combo in out_sample:
-                cdf_sublist, sample_sublist = combo
-                obs_boot.extend(sample_sublist)
-                cdf_boot.extend(cdf_sublist)
-            pool.close()
-            pool.join()
-        if model in ['asne', 'agsne']: obs_boot = np.sort(obs_boot[:N]) ** 0.5 # Convert to diameter
-        else: obs_boot = np.sort(obs_boot[:N])
-        sample_rsquare = mtools.obs_pred_rsquare(np.log10(obs_boot), np.log10(pred))
-        sample_ks = max(abs(emp_cdf - np.sort(cdf_boot[:N])))
-        
-        wk.write_to_file(out_dir + 'ISD_bootstrap_' + model + '_rsquare.txt', "".join([',', str(sample_rsquare)]), new_line = False)
-        wk.write_to_file(out_dir + 'ISD_bootstrap_' + model + '_ks.txt', "".join([',', str(sample_ks)]), new_line = False)
+    if unit is None:
+        if model in ['ssnt_0', 'ssnt_1']: cdf_obs = dist.cdf(obs)
+        else: cdf_obs = np.array([dist.cdf(x) for x in obs])
+        unit = {'dataset': dat_name, 'site': str(site), 'pattern': 'ISD', 'model': model, 'input_hash': input_hash, 
+                'orig': {'rsquare': float(mtools.obs_pred_rsquare(np.log10(obs), np.log10(pred))), 
+                         'ks': float(max(abs(emp_cdf - cdf_obs)))}, 
+                'samples': {'rsquare': [], 'ks': []}}
+    
+    def sampler(num_new):
+        # Samples are only requested for one checkpoint at a time, so that none are wasted if sampling stops early
+        isd_samples = get_isd_bootstrap_samples(dist, N, num_new, pool = pool)
+        stats_new = {'rsquare': [], 'ks': []}
+        for i in xrange(num_new):
+            with profile_stage('sample'):
+                cdf_boot, obs_boot = next(isd_samples)
+            with profile_stage('statistic'):
+                if model in ['asne', 'agsne']: obs_boot = np.sort(obs_boot) ** 0.5 # Convert to diameter
+                else: obs_boot = np.sort(obs_boot)
+                stats_new['rsquare'].append(mtools.obs_pred_rsquare(np.log10(obs_boot), np.log10(pred)))
+                stats_new['ks'].append(max(abs(emp_cdf - np.sort(cdf_boot))))
+        return stats_new
+    run_bootstrap_unit(unit_path, unit, Niter, sampler, checkpoint_every = checkpoint_every, 
+                       ci_width = ci_width, min_iter = min_iter, shard = shard, num_shards = num_shards)
     
-    wk.write_to_file(out_dir + 'ISD_bootstrap_' + model + '_rsquare.txt', '\t')
-    wk.write_to_file(out_dir + 'ISD_bootstrap_' + model + '_ks.txt', '\t')
-    wk.write_to_file(out_dir + 'ISD_bootstrap_' + model + '_ks.txt', ",".join(str(x) for x in out_list_ks))
+def draw_sdr_sample(dist, model, n_sp, m_sp, num_iter):
+    """Draw D^2 for all individuals in the community for num_iter bootstrap samples at once.
     
-def bootstrap_SDR(name_site_combo, model, in_dir = './data/', out_dir = './out_files/', Niter = 200):
+    Inputs:
+    dist - ssnt_isd_bounded for 'ssnt_0' and 'ssnt_1', theta_epsilon for 'asne', or theta_agsne for 'agsne'
+    model - one of 'ssnt_0', 'ssnt_1', 'asne', or 'agsne'
+    n_sp, m_sp - arrays with the abundance of each species and the number of species within its genus
+    num_iter - number of bootstrap samples
+    
+    Output:
+    Array with num_iter rows and one column for each individual, with individuals grouped by species 
+    in the order of n_sp.
+    
+    """
+    n_sp, m_sp = np.asarray(n_sp), np.asarray(m_sp)
+    N = np.sum(n_sp)
+    if model in ['ssnt_0', 'ssnt_1']: # P(d|n) is the ISD for all species
+        return np.reshape(dist.rvs(num_iter * N), (num_iter, N)) ** 2
+    elif model == 'asne': # theta_epsilon is an exponential distribution with rate lambda2 * n truncated to [1, E0]
+        n_ind = np.repeat(n_sp, n_sp)
+        rand_unif = stats.uniform.rvs(size = (num_iter, N))
+        return 1 - np.log1p(rand_unif * np.expm1(-(dist.sigma - dist.beta) * n_ind)) / (dist.lambda2 * n_ind)
+    else: # Species with the same n and m share the same distribution, and are drawn together
+        out = np.empty((num_iter, N))
+        offsets = np.concatenate(([0], np.cumsum(n_sp)[:-1]))
+        sp_groups = {}
+        for i, (n, m) in enumerate(zip(n_sp, m_sp)):
+            sp_groups.setdefault((n, m), []).append(i)
+        for (n, m), sp_list in sp_groups.items():
+            sample = np.reshape(dist.rvs(n, num_iter * n * len(sp_list), m), (num_iter, len(sp_list), n))
+            for j, sp in enumerate(sp_list):
+                out[:, offsets[sp]:(offsets[sp] + n)] = sample[:, j, :]
+        return out
+
+def get_sdr_bootstrap_means(dist, model, n_sp, m_sp, Niter, max_values = 10 ** 7):
+    """Average D^2 within each species for Niter bootstrap samples of the SDR.
+    
+    Individuals are drawn with draw_sdr_sample() in blocks of as many samples as fit in max_values 
+    values, and averaged within species with np.add.reduceat over the species offsets. 
+    Returns an array with Niter rows and one column for each species.
+    
+    """
+    n_sp = np.asarray(n_sp)
+    offsets = np.concatenate(([0], np.cumsum(n_sp)[:-1]))
+    iter_per_block = max(1, max_values // np.sum(n_sp))
+    out = []
+    for start in xrange(0, Niter, iter_per_block):
+        sample = draw_sdr_sample(dist, model, n_sp, m_sp, min(iter_per_block, Niter - start))
+        out.append(np.add.reduceat(sample, offsets, axis = 1) / n_sp)
+    return np.concatenate(out)
+
+def bootstrap_SDR(name_site_combo, model, in_dir = './data/', out_dir = './out_files/', Niter = 200, site_idx = None, 
+                  checkpoint_every = 50, ci_width = None, min_iter = 50, shard = None, num_shards = 1):
     """A general function of bootstrapping for ISD applying to all four models. 
     
     Inputs:
     name_site_combo: a list with dat_name and site
     model - takes one of four values 'ssnt_0', 'ssnt_1', 'asne', or 'agsne'
-    in_dir - directory of raw data
+    in_dir - directory of raw data, cleaned and cached on first use by ingest_raw_data()
     out_dir - directory used both in input (obs_pred.csv file) and output 
     Niter - number of bootstrap samples
+    site_idx - site_index of the cleaned site data, built here if not provided.
+    checkpoint_every - number of samples between checkpoints
+    ci_width, min_iter - settings of the sequential mode, which stops early once the quantiles of the 
+        observed statistics are precise enough (see run_bootstrap_unit())
+    shard, num_shards - only draw one of num_shards parts of the samples (see run_bootstrap_unit())
     
     Output:
-    Writes to one file on disk for R^2.
+    Writes to disk one checkpoint file for the site with R^2, which is skipped if already 
+    complete and resumed if partly finished, unless the site data or the analyses have changed 
+    since (see get_bootstrap_hash()). See merge_bootstrap_units() for the combined output.
     
     """
     dat_name, site = name_site_combo
-    dat = wk.import_raw_data(in_dir + dat_name + '.csv')
-    dat_site = dat[dat['site'] == site]
-    dat_clean = clean_data_agsne(dat_site)    
-    G, S, N, E = get_GSNE(dat_clean)
-    lambda1, beta, lambda3 = agsne.get_agsne_lambdas(G, S, N, E)
-    
-    par_list = []
-    for sp in np.unique(dat_clean['sp']):
-        dat_sp = dat_clean[dat_clean['sp'] == sp]
-        n = len(dat_sp)
-        genus_sp = dat_sp['genus'][0]
-        m = len(np.unique(dat_clean[dat_clean['genus'] == genus_sp]['sp']))
-        par_list.append([m, n])
-        
-    pred_obs = wk.import_obs_pred_data(out_dir + dat_name + '_obs_pred_sdr_' + model + '.csv')
-    pred = pred_obs[pred_obs['site'] == site]['pred']
-    obs = pred_obs[pred_obs['site'] == site]['obs'] 
-    out_list_rsquare = [dat_name, site, str(mtools.obs_pred_rsquare(np.log10(obs), np.log10(pred)))]
-    
-    iisd_agsne = mete_distributions.theta_agsne([G, S, N, E], [lambda1, beta, lambda3, agsne.agsne_lambda3_z(lambda1, beta, S) / lambda3])
-    iisd_asne = mete_distributions.theta_epsilon(S, N, E)
-    dbh_scaled = np.array(dat_clean['dbh'] / min(dat_clean['dbh']))
-    iisd_ssnt_0 = ssnt_isd_bounded(1, N / (sum(dbh_scaled ** 1) - N))
-    iisd_ssnt_1 = ssnt_isd_bounded(2/3, N / (sum(dbh_scaled ** (2/3)) - N))
-    dist_for_model = {'ssnt_0': iisd_ssnt_0, 'ssnt_1': iisd_ssnt_1, 'asne': iisd_asne, 'agsne': iisd_agsne}
-    dist = dist_for_model[model]
-        
-    for i in range(Niter):
-        if model in ['ssnt_0', 'ssnt_1']: obs_boot = np.array([np.mean((dist.rvs(par[1])) ** 2) for par in par_list]) # Here par[1] is n for each species
-        elif model == 'asne': 
-            obs_boot = np.array([np.mean(np.array(dist.rvs(par[1], par[1]))) for par in par_list])
-        else:
-            obs_boot = np.array([np.mean(np.array(dist.rvs(par[1], par[1], par[0]))) for par in par_list])
-        out_list_rsquare.append(str(mtools.obs_pred_rsquare(np.log10(obs_boot), np.log10(pred))))
+    unit_path = get_bootstrap_unit_path(out_dir, 'SDR', model, dat_name, site)
+    dat_clean = get_site_data(dat_name, site, in_dir = in_dir)
+    input_hash = get_bootstrap_hash(dat_clean, 'SDR', model, checkpoint_every)
+    unit = load_bootstrap_unit(unit_path, input_hash = input_hash)
+    if unit is not None and is_bootstrap_unit_complete(unit, Niter, ci_width = ci_width, min_iter = min_iter): return
+    if site_idx is None: site_idx = site_index(dat_clean)
     
-    wk.write_to_file(out_dir + 'SDR_bootstrap_' + model + '_rsquare.txt', ",".join(str(x) for x in out_list_rsquare))
+    obs, pred = get_obs_pred_site(dat_name, site, 'sdr', model, out_dir = out_dir)
+    if unit is None:
+        unit = {'dataset': dat_name, 'site': str(site), 'pattern': 'SDR', 'model': model, 'input_hash': input_hash, 
+                'orig': {'rsquare': float(mtools.obs_pred_rsquare(np.log10(obs), np.log10(pred)))}, 
+                'samples': {'rsquare': []}}
+    
+    dist = get_pattern_dist('SDR', model, dat_clean, site_idx)
+        
+    def sampler(num_new):
+        with profile_stage('sample'):
+            obs_boot = get_sdr_bootstrap_means(dist, model, site_idx.sp_counts, site_idx.sp_m, num_new)
+        with profile_stage('statistic'):
+            return {'rsquare': obs_pred_rsquare_rows(np.log10(obs_boot), np.log10(pred))}
+    run_bootstrap_unit(unit_path, unit, Niter, sampler, checkpoint_every = checkpoint_every, 
+                       ci_width = ci_width, min_iter = min_iter, shard = shard, num_shards = num_shards)
             
 def plot_hist_quan(dat_file, dat_type = 'r2', ax = None):    
     """Similar to the function under the same name in working_functions,
     
-    only with different text.
+    only with different text. The quantiles are computed for all sites at once with boot_summary.get_quantiles().
     
     """
+    dataset, site, orig, samples = boot_summary.from_structured(dat_file) # Units stopped early are padded with nan
+    return plot_quan_hist(boot_summary.get_quantiles(orig, samples, dat_type = dat_type), ax = ax)
+
+def plot_quan_hist(quan_list, ax = None):
+    """Histogram of the quantiles of the observed statistics among the bootstrap samples, as in plot_hist_quan()."""
     if not ax:
         fig = plt.figure(figsize = (3.5, 3.5))
         ax = plt.subplot(111)
-  
-    quan_list = []
-    num_row = len(dat_file['dataset'])
-    for i in range(num_row):
-        dat_row = list(dat_file[i])
-        stat_orig = dat_row[2]
-        stat_sim = dat_row[3:]
-        if dat_type == 'r2':
-            quan_row = len([x for x in stat_sim if x < stat_orig]) / len(stat_sim)
-        else: quan_row = len([x for x in stat_sim if x > stat_orig]) / len(stat_sim)
-        quan_list.append(quan_row)
     
+    quan_list = np.asarray(quan_list, dtype = float)
+    quan_list = quan_list[~np.isnan(quan_list)]
+    num_zero, num_site = boot_summary.count_zero_quantiles(quan_list)
     n, bins, patches = plt.hist(quan_list,  facecolor='grey', alpha=0.5, range = (0, 1))
-    ax.annotate('Zero quantile: ' + str(len([x for x in quan_list if x == 0])) + '/' + str(len(quan_list)), \
+    ax.annotate('Zero quantile: ' + str(num_zero) + '/' + str(num_site), \
                 xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 8)
     ax.tick_params(axis = 'both', which = 'major', labelsize = 6)
     plt.ylim(0, max(n) * 1.2)
     return ax
       
-def plot_bootstrap(model, Niter = 500, out_file_dir = './out_files/', out_fig_dir = './out_figs/'):
+def plot_bootstrap(model, Niter = 500, out_file_dir = './out_files/', out_fig_dir = './out_figs/', cache = None):
     """Plot the bootstrap results for the a given model and the three patterns (SAD, ISD, SDR). 
     
     The output is a 3*2 plot (with the last subplot missing) with name bootstrap_model.pdf.
+    cache - results_cache for out_file_dir, created here if not provided
+    The quantiles are read from the summary tables of merge_bootstrap_units() when they have at most Niter samples per site 
+    (see results_cache.get_bootstrap_summary()).
     
     """
+    if cache is None: cache = results_cache(out_file_dir)
     patterns = ['SAD', 'ISD', 'SDR']
     stats = ['rsquare', 'ks']
     titles = [r'$R^2$', 'K-S Statistic']
@@ -653,11 +2122,9 @@ def plot_bootstrap(model, Niter = 500, out_file_dir = './out_files/', out_fig_di
     for pattern in patterns:
         for stat in stats:
             if iplot < 6:
-                boot_dir = out_file_dir + pattern + '_bootstrap_' + model + '_' + stat + '.txt'
-                boot_out = import_bootstrap_file_incomp(boot_dir, Niter = Niter)
+                summary = cache.get_bootstrap_summary(pattern, model, stat, Niter = Niter)
                 ax = plt.subplot(3, 2, iplot)
-                if stat == 'ks': plot_hist_quan(boot_out, dat_type = 'ks', ax = ax)
-                else: plot_hist_quan(boot_out, ax = ax)
+                plot_quan_hist(summary['quantile'], ax = ax)
                 plt.xlabel('Samples closer to prediction', fontsize = 8)
                 plt.ylabel('Number of communities', fontsize = 8)
                 if iplot in [1, 2]: ax.set_title(titles[iplot - 1], size = 14,y = 1.1)
@@ -667,12 +2134,15 @@ def plot_bootstrap(model, Niter = 500, out_file_dir = './out_files/', out_fig_di
     plt.subplots_adjust(left = 0.17, top = 0.95, bottom = 0.05, right = 0.95, wspace = 0.3, hspace = 0.3)
     plt.savefig(out_fig_dir + 'bootstrap_' + model + '.png', dpi = 400)
     
-def plot_obs_pred_four_models(dat_list, out_file_dir = './out_files/', out_fig_dir = './out_figs/'):
+def plot_obs_pred_four_models(dat_list, out_file_dir = './out_files/', out_fig_dir = './out_figs/', cache = None):
     """Create the obs-pred plots for the three patterns (SAD, ISD, and SDR) and four models.
     
     The output is a 4*3 plot with name obs_pred_3patterns_4models.pdf.
+    cache - results_cache for out_file_dir, created here if not provided
     
     """
+    if cache is None: cache = results_cache(out_file_dir)
+    get_result_sink().flush()
     dat_list_exist = [x for x in dat_list if os.path.isfile(out_file_dir + x + '_obs_pred_rad_asne.csv')]
     model_list = ['asne', 'agsne', 'ssnt_0', 'ssnt_1']
     pattern_list = ['rad', 'isd', 'sdr']
@@ -685,8 +2155,7 @@ def plot_obs_pred_four_models(dat_list, out_file_dir = './out_files/', out_fig_d
     iplot = 1
     for model in model_list:
         for pattern in pattern_list:
-            filename = '_obs_pred_' + pattern + '_' + model + '.csv'
-            sites, obs, pred = wk.get_obs_pred_from_file(dat_list_exist,out_file_dir, filename)
+            obs, pred = cache.get_obs_pred_datasets(dat_list_exist, pattern, model)
             ax = plt.subplot(4, 3, iplot)
             ax = wk.plot_obs_pred(obs, pred, 2, True, ax = ax)
             xlab, ylab = xylabel[pattern]
@@ -698,4 +2167,304 @@ def plot_obs_pred_four_models(dat_list, out_file_dir = './out_files/', out_fig_d
             iplot += 1
     plt.subplots_adjust(left = 0.17, top = 0.95, bottom = 0.05, right = 0.95, wspace = 0.3, hspace = 0.3)
     plt.savefig(out_fig_dir + 'obs_pred_3patterns_4models.png', dpi = 400)
-            
\ No newline at end of file
+
+def build_task_graph(dat_site_sizes, model_list = ('ssnt_0', 'ssnt_1', 'asne', 'agsne'), 
+                     pattern_list = ('SAD', 'ISD', 'SDR'), bootstrap = True, shard_N = 100000):
+    """Expand the analyses into tasks with explicit dependencies.
+    
+    Inputs:
+    dat_site_sizes - list of [dat_name, site, N] for the sites that pass the cleaning
+    model_list, pattern_list - models and patterns to analyze
+    bootstrap - whether to include the bootstrap analyses
+    shard_N - the bootstrap of a site with N individuals is split into min(core_budget, N // shard_N) 
+        shards (see run_bootstrap_unit()), so that large sites do not hold up the whole run
+    
+    Output:
+    A dictionary mapping each task to [list of tasks it depends on, priority]. Each task is a tuple 
+    (stage, dat_name, site, model, pattern, shard), with stage one of 'obs_pred', 'bootstrap', 'merge', and 'plot', 
+    shard either None or (shard, num_shards) for bootstrap tasks split into shards, and None for the 
+    elements that do not apply. There is one obs_pred task for each site, which obtains all models and 
+    patterns and the likelihood at once with evaluate_site(). The plot tasks of the likelihood (which is only 
+    written with all four models, see evaluate_site()) and of the obs_pred values are only included when 
+    model_list (and for the latter pattern_list) has all of them. Tasks whose outputs are up to date 
+    (see update_site() and get_bootstrap_hash()) return without recomputing them, so that after correcting 
+    a dataset only the sites whose data changed are recomputed. Priority is the number of individuals in 
+    the site, so that large sites are started first.
+    
+    The plot tasks draw the log-likelihood comparisons (Fig. 1), the predicted versus observed values (Fig. 2), 
+    the R^2 comparisons (Fig. 3), and the bootstrap results of each model (Figs. B1 - B4). The bootstrap of 
+    each (dataset, site, model, pattern) is checkpointed in out_files/bootstrap_units/, so that an interrupted 
+    run can simply be started again, and its random streams are seeded by bootstrap_seed and the unit, so that 
+    the results do not depend on how it is split into shards.
+    
+    """
+    graph = {}
+    obs_pred_tasks = []
+    for dat_name, site, N in dat_site_sizes:
+        obs_pred_task = ('obs_pred', dat_name, site, None, None, None)
+        num_shards = max(1, min(core_budget, N // shard_N))
+        graph[obs_pred_task] = [[], N]
+        obs_pred_tasks.append(obs_pred_task)
+        for pattern in pattern_list:
+            for model in model_list:
+                if bootstrap and num_shards == 1: 
+                    graph[('bootstrap', dat_name, site, model, pattern, None)] = [[obs_pred_task], N]
+                elif bootstrap:
+                    for shard in xrange(num_shards):
+                        graph[('bootstrap', dat_name, site, model, pattern, (shard, num_shards))] = [[obs_pred_task], N]
+    if set(['asne', 'agsne', 'ssnt_0', 'ssnt_1']) <= set(model_list): # The figures compare the four models
+        graph[('plot', None, None, None, 'lik', None)] = [list(obs_pred_tasks), 0]
+        if set(['SAD', 'ISD', 'SDR']) <= set(pattern_list): 
+            graph[('plot', None, None, None, 'obs_pred', None)] = [list(obs_pred_tasks), 0]
+    if bootstrap:
+        for model in model_list:
+            for pattern in pattern_list:
+                graph[('merge', None, None, model, pattern, None)] = [[task for task in graph if task[0] == 'bootstrap' and 
+                                                                       task[3] == model and task[4] == pattern], 0]
+            graph[('plot', None, None, model, 'bootstrap', None)] = [[('merge', None, None, model, pattern, None) 
+                                                                     for pattern in pattern_list], 0]
+    return graph
+
+def run_analysis_task(task, options):
+    """Run a single task from build_task_graph(), returning (task, None) or (task, traceback) if it fails.
+    
+    options - dictionary with 'Niter' (number of bootstrap samples), 'dat_site_list' (list of 
+    [dat_name, site]) and 'dat_list' (list of datasets with at least one site), and optionally 
+    'ci_width' (see run_bootstrap_unit()) to stop bootstrap units early, which is ignored for units split into shards, 
+    and 'model_list' and 'pattern_list' for the obs_pred tasks (by default all four models and three patterns)
+    
+    """
+    stage, dat_name, site, model, pattern, shard = task
+    set_profile_tags(dataset = dat_name, site = site, model = model, pattern = pattern)
+    try:
+        if stage == 'obs_pred':
+            update_site(dat_name, site, models = options.get('model_list', ['ssnt_0', 'ssnt_1', 'asne', 'agsne']), 
+                        patterns = list(options.get('pattern_list', ['SAD', 'ISD', 'SDR'])) + ['lik'])
+        elif stage == 'bootstrap':
+            bootstrap_func = {'SAD': bootstrap_SAD, 'ISD': bootstrap_ISD, 'SDR': bootstrap_SDR}[pattern]
+            if shard is None: bootstrap_func([dat_name, site], model, Niter = options['Niter'], ci_width = options.get('ci_width'))
+            else: bootstrap_func([dat_name, site], model, Niter = options['Niter'], shard = shard[0], num_shards = shard[1])
+        elif stage == 'merge': merge_bootstrap_units(pattern, model)
+        elif stage == 'plot': # The rows written by the obs_pred tasks are first put in a fixed order
+            if pattern == 'lik': 
+                sort_site_rows('./out_files/lik_sp_abd_dbh_four_models.txt', 2, delimiter = ' ')
+                plot_likelihood_comp()
+            elif pattern == 'obs_pred': 
+                for dat_name in set(options['dat_list']):
+                    for pattern_file in ['rad', 'isd', 'sdr']:
+                        for model_file in options.get('model_list', ['ssnt_0', 'ssnt_1', 'asne', 'agsne']):
+                            sort_site_rows('./out_files/' + dat_name + '_obs_pred_' + pattern_file + '_' + model_file + '.csv', 1)
+                cache = results_cache()
+                plot_obs_pred_four_models(options['dat_list'], cache = cache)
+                plot_r2_comp(options['dat_site_list'], cache = cache)
+            elif pattern == 'bootstrap': plot_bootstrap(model, Niter = options['Niter'])
+        return task, None
+    except Exception:
+        return task, traceback.format_exc()
+    finally:
+        get_result_sink().flush()
+        flush_profile()
+
+def run_task_graph(graph, options, processes = None, single_writer = False):
+    """Run the tasks in graph (see build_task_graph()) on one process pool, respecting dependencies.
+    
+    At most processes tasks (by default core_budget) run at any time, and among the tasks 
+    whose dependencies are done, the one with the highest priority is started first. 
+    options are passed to run_analysis_task(); e.g. 'ci_width': 0.05 stops each bootstrap once the quantile 
+    of its observed statistics is known to within that width, instead of always drawing Niter samples. 
+    If profile_dir is set (e.g. to './out_files/profile/'), the profile of all tasks (timers and counters by 
+    dataset, site, model, pattern and stage) is written to profile.csv in profile_dir. 
+    To spread the tasks over several nodes that share the file system, use submit_task_graph() instead. 
+    With single_writer, the text output of all workers is written by one writer process (see start_sink_writer()), 
+    which has written all rows of the finished tasks before a plot task starts.
+    
+    """
+    if processes is None: processes = core_budget
+    reset_profile()
+    dependents = dict((task, []) for task in graph)
+    num_deps = {}
+    for task, (deps, priority) in graph.items():
+        num_deps[task] = len(deps)
+        for dep in deps: dependents[dep].append(task)
+    order = dict((task, i) for i, task in enumerate(sorted(graph))) # Breaks ties in priority
+    ready = [(-graph[task][1], order[task], task) for task in graph if num_deps[task] == 0]
+    heapq.heapify(ready)
+    if single_writer:
+        sink_queue, sink_writer = start_sink_writer()
+        pool = multiprocessing.Pool(processes, set_result_sink, (queue_sink(sink_queue), ))
+    else: pool = multiprocessing.Pool(processes)
+    running = []
+    try:
+        while ready or running:
+            while ready and len(running) < processes:
+                task = heapq.heappop(ready)[2]
+                if single_writer and task[0] == 'plot': sink_queue.join()
+                running.append(pool.apply_async(run_analysis_task, (task, options)))
+            time.sleep(0.05)
+            for result in [x for x in running if x.ready()]:
+                running.remove(result)
+                task, error = result.get()
+                if error is not None: 
+                    raise RuntimeError('Task ' + str(task) + ' failed:\n' + error)
+                for dependent in dependents[task]:
+                    num_deps[dependent] -= 1
+                    if num_deps[dependent] == 0: heapq.heappush(ready, (-graph[dependent][1], order[dependent], dependent))
+    finally:
+        pool.terminate()
+        pool.join()
+        if single_writer: stop_sink_writer(sink_queue, sink_writer)
+        if profile_dir is not None: merge_profile(os.path.join(profile_dir, 'profile.csv'))
+
+def get_task_name(task):
+    """File name of a task in the task queue (see submit_task_graph())."""
+    return hashlib.md5(json.dumps(task)).hexdigest()
+
+def submit_task_graph(graph, options, queue_dir):
+    """Write a task graph (see build_task_graph()) and its options to queue_dir, to be run by run_queue_worker().
+    
+    Any number of workers, on any node that shares the file system, then claim and run the tasks. 
+    queue_dir contains graph.json with the tasks, claims/ with the lock files of the tasks being run, 
+    done/ with one file for each finished task, and failed/ with the traceback of each failed task. 
+    Tasks that are already done (e.g. in an earlier submission of the same graph) are not run again, 
+    while failed tasks are tried again.
+    
+    """
+    for sub_dir in ['claims', 'done', 'failed']:
+        if not os.path.isdir(os.path.join(queue_dir, sub_dir)): os.makedirs(os.path.join(queue_dir, sub_dir))
+    for failed_file in os.listdir(os.path.join(queue_dir, 'failed')):
+        os.remove(os.path.join(queue_dir, 'failed', failed_file))
+    tasks = [[list(task), [get_task_name(dep) for dep in sorted(deps)], priority, get_task_name(task)] 
+             for task, (deps, priority) in sorted(graph.items())]
+    write_file_atomic(os.path.join(queue_dir, 'graph.json'), json.dumps({'tasks': tasks, 'options': options}))
+
+def load_task_queue(queue_dir):
+    """Tasks of the queue in queue_dir as a list of (task, names of dependencies, priority, name), and options."""
+    with open(os.path.join(queue_dir, 'graph.json')) as f:
+        queue = json.load(f)
+    tasks = []
+    for task, deps, priority, name in queue['tasks']:
+        task = tuple([str(x) if isinstance(x, unicode) else x for x in task[:5]] + [tuple(task[5]) if task[5] is not None else None])
+        tasks.append((task, deps, priority, name))
+    return tasks, queue['options']
+
+def get_fs_time(queue_dir):
+    """Current time of the shared file system, as the modification time of a file just touched in queue_dir, 
+    
+    so that the leases of workers on nodes with different clocks are compared on the same clock.
+    
+    """
+    clock_path = os.path.join(queue_dir, 'claims', 'clock_' + socket.gethostname() + '_' + str(os.getpid()))
+    with open(clock_path, 'a'):
+        os.utime(clock_path, None)
+    return os.stat(clock_path).st_mtime
+
+def get_task_locks(queue_dir):
+    """Dictionary mapping the name of each claimed task in queue_dir to the generation of its latest lock file."""
+    locks = {}
+    for lock_file in os.listdir(os.path.join(queue_dir, 'claims')):
+        if not lock_file.endswith('.lock'): continue
+        name, gen = lock_file[:-len('.lock')].rsplit('.', 1)
+        locks[name] = max(locks.get(name, 0), int(gen))
+    return locks
+
+def get_queue_status(queue_dir):
+    """Names of the tasks in queue_dir by status: 'done', 'failed', 'blocked' (depending on a failed task), 
+    
+    'claimed' (being run), and 'ready' and 'waiting' (for their dependencies) for the others.
+    
+    """
+    tasks, options = load_task_queue(queue_dir)
+    done = set(os.listdir(os.path.join(queue_dir, 'done')))
+    failed = set(os.listdir(os.path.join(queue_dir, 'failed'))) - done
+    locks = get_task_locks(queue_dir)
+    blocked, num_blocked = set(), -1
+    while len(blocked) > num_blocked:
+        num_blocked = len(blocked)
+        blocked.update([name for task, deps, priority, name in tasks if name not in done and name not in failed and 
+                        any([dep in failed or dep in blocked for dep in deps])])
+    status = {'done': done & set([name for task, deps, priority, name in tasks]), 'failed': failed, 'blocked': blocked, 
+              'claimed': set(), 'ready': set(), 'waiting': set()}
+    for task, deps, priority, name in tasks:
+        if name in done or name in failed or name in blocked: continue
+        elif name in locks: status['claimed'].add(name)
+        elif all([dep in done for dep in deps]): status['ready'].add(name)
+        else: status['waiting'].add(name)
+    return status
+
+def claim_queue_task(queue_dir, lease_seconds = 600):
+    """Claim a ready task of the queue in queue_dir, returning (task, lock path), or (None, None) if there is none.
+    
+    Among the tasks whose dependencies are done, the one with the highest priority is tried first. 
+    A task is claimed by creating its lock file with O_EXCL, which only one process can do. 
+    The lock files of a task are numbered: if the latest one has not been touched for lease_seconds 
+    (see run_queue_worker()), it is taken to belong to a worker that died, and the task can be claimed 
+    again by creating the next one, so that it is run again.
+    
+    """
+    tasks, options = load_task_queue(queue_dir)
+    status = get_queue_status(queue_dir)
+    locks = get_task_locks(queue_dir)
+    fs_time = get_fs_time(queue_dir)
+    order = dict((name, i) for i, (task, deps, priority, name) in enumerate(tasks))
+    candidates = [(-priority, order[name], task, name) for task, deps, priority, name in tasks 
+                  if name in status['ready'] or name in status['claimed']]
+    for neg_priority, i, task, name in sorted(candidates):
+        gen = 0
+        if name in locks:
+            try: 
+                if fs_time - os.stat(os.path.join(queue_dir, 'claims', name + '.' + str(locks[name]) + '.lock')).st_mtime < lease_seconds: 
+                    continue
+            except OSError: continue
+            gen = locks[name] + 1
+        lock_path = os.path.join(queue_dir, 'claims', name + '.' + str(gen) + '.lock')
+        try: fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError: continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'time': fs_time}))
+        if os.path.exists(os.path.join(queue_dir, 'done', name)): # Finished since the status was read
+            os.remove(lock_path)
+            continue
+        return task, lock_path
+    return None, None
+
+def _renew_lease(lock_path, lease_seconds, stop):
+    """Touch lock_path every lease_seconds / 4 until stop is set or the lock is taken away."""
+    while not stop.wait(lease_seconds / 4):
+        try: os.utime(lock_path, None)
+        except OSError: return
+
+def run_queue_worker(queue_dir, lease_seconds = 600, poll_seconds = 5):
+    """Claim and run the tasks of the queue in queue_dir (see submit_task_graph()) until none is left to run.
+    
+    While a task runs, its lock file is touched regularly, so that other workers do not take it over 
+    (see claim_queue_task()). A finished task is marked in done/ (or in failed/ with its traceback), and 
+    its lock files are then removed. Tasks are idempotent (see update_site() and run_bootstrap_unit()), 
+    so a task run again after its lease expired gives the same results, and the merged bootstrap files 
+    and the obs_pred files (sorted by site before plotting) do not depend on which worker ran which task. 
+    Each worker uses up to core_budget processes for the bootstrap of the ISD, so that several workers on one 
+    node should split its cores between them (see the --workers option of ssnt_mete_queue_worker.py). 
+    Returns the status of the queue (see get_queue_status()).
+    
+    """
+    tasks, options = load_task_queue(queue_dir)
+    while True:
+        status = get_queue_status(queue_dir)
+        if not (status['ready'] or status['claimed'] or status['waiting']): return status
+        task, lock_path = claim_queue_task(queue_dir, lease_seconds = lease_seconds)
+        if task is None: 
+            time.sleep(poll_seconds)
+            continue
+        stop = threading.Event()
+        renewer = threading.Thread(target = _renew_lease, args = (lock_path, lease_seconds, stop))
+        renewer.daemon = True
+        renewer.start()
+        try: task, error = run_analysis_task(task, options)
+        finally:
+            stop.set()
+            renewer.join()
+        name = get_task_name(task)
+        if error is None: write_file_atomic(os.path.join(queue_dir, 'done', name), json.dumps(task))
+        else: write_file_atomic(os.path.join(queue_dir, 'failed', name), json.dumps(task) + '\n' + error)
+        for lock_file in glob.glob(os.path.join(queue_dir, 'claims', name + '.*.lock')):
+            try: os.remove(lock_file)
+            except OSError: pass
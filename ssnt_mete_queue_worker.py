@@ -0,0 +1,38 @@
+"""Worker of the file-system task queue, to run the analyses on several nodes that share a file system.
+
+The task graph is first submitted to a queue directory, e.g. with
+    smc.submit_task_graph(task_graph, options, './out_files/queue/')
+(see ssnt_mete_comp_analysis.py), and any number of workers are then started on any node, from the
+directory that contains ./data/ and ./out_files/:
+    python ssnt_mete_queue_worker.py ./out_files/queue/
+Each worker claims and runs tasks until none is left, and prints the status of the queue when it exits.
+Several workers can be started on one host, e.g. to test the queue locally. They then share the cores of
+the node (--cores) between them, given their number with --workers:
+    python ssnt_mete_queue_worker.py ./out_files/queue/ --cores 16 --workers 4
+
+"""
+from __future__ import division
+import matplotlib
+matplotlib.use('Agg')
+import sys
+import argparse
+import ssnt_mete_comparison as smc
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Worker of the file-system task queue of the analyses.')
+    parser.add_argument('queue_dir')
+    parser.add_argument('--lease', type = float, default = 600, 
+                        help = 'seconds after which the task of a worker that stopped renewing its lock is run again')
+    parser.add_argument('--poll', type = float, default = 5, help = 'seconds between checks for ready tasks')
+    parser.add_argument('--cores', type = int, default = None, 
+                        help = 'number of cores of this node shared by all its workers (default: all cores)')
+    parser.add_argument('--workers', type = int, default = 1, 
+                        help = 'number of workers started on this node, each of which uses cores / workers processes '
+                               'for the bootstrap of the ISD (default: 1)')
+    args = parser.parse_args()
+
+    if args.cores is not None: smc.core_budget = args.cores
+    smc.core_budget = max(1, smc.core_budget // args.workers)
+    status = smc.run_queue_worker(args.queue_dir, lease_seconds = args.lease, poll_seconds = args.poll)
+    print ' '.join([key + ': ' + str(len(status[key])) for key in ['done', 'failed', 'blocked']])
+    sys.exit(1 if status['failed'] else 0)
@@ -0,0 +1,78 @@
+"""Regression tests of the vectorized bootstrap summaries against the loops over rows they replace.
+
+Run with python -m unittest discover (or pytest) from the directory of the module.
+
+"""
+from __future__ import division
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import ssnt_mete_bootstrap_summary as boot_summary
+
+def get_quantiles_loop(orig, samples, dat_type = 'r2'):
+    """Quantiles of the observed statistics, as computed row by row in plot_hist_quan() before."""
+    quan_list = []
+    for i in range(len(orig)):
+        stat_orig = orig[i]
+        stat_sim = [x for x in samples[i] if not np.isnan(x)] # Units stopped early are padded with nan
+        if dat_type == 'r2':
+            quan_row = len([x for x in stat_sim if x < stat_orig]) / len(stat_sim)
+        else: quan_row = len([x for x in stat_sim if x > stat_orig]) / len(stat_sim)
+        quan_list.append(quan_row)
+    return np.array(quan_list)
+
+class test_get_quantiles(unittest.TestCase):
+    def setUp(self):
+        prng = np.random.RandomState(11)
+        num_row, num_col = 40, 25
+        self.orig = prng.uniform(size = num_row)
+        self.samples = np.round(prng.uniform(size = (num_row, num_col)), 2)
+        self.samples[:5, :5] = self.orig[:5, None] # Ties with the observed statistic
+        lengths = prng.randint(1, num_col + 1, size = num_row)
+        self.samples[np.arange(num_col) >= lengths[:, None]] = np.nan
+
+    def test_quantiles_match_loop(self):
+        for dat_type in ['r2', 'ks']:
+            np.testing.assert_array_equal(boot_summary.get_quantiles(self.orig, self.samples, dat_type = dat_type),
+                                          get_quantiles_loop(self.orig, self.samples, dat_type = dat_type))
+
+    def test_summary_quantiles(self):
+        summary = boot_summary.summarize_bootstrap(np.array(['a'] * len(self.orig)), np.arange(len(self.orig)).astype(str),
+                                                   self.orig, self.samples, dat_type = 'ks')
+        np.testing.assert_array_equal(summary['quantile'], get_quantiles_loop(self.orig, self.samples, dat_type = 'ks'))
+        np.testing.assert_array_equal(summary['num_samples'], np.sum(~np.isnan(self.samples), axis = 1))
+
+class test_load_bootstrap_matrix(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir, 'SAD_bootstrap_asne_rsquare.txt')
+        self.rows = [('BCI', '1', 0.9, [0.5, 0.95, 0.7, 0.2]), ('Cocoli', '1', 0.8, [0.85, 0.1]),
+                     ('Sherman', '2', 0.7, [])]
+        with open(self.file_path, 'w') as f:
+            for dataset, site, orig, samples in self.rows:
+                f.write(','.join([dataset, site, repr(orig)] + [repr(x) for x in samples]) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_niter(self):
+        for Niter in [None, 1, 3, 6]:
+            dataset, site, orig, samples = boot_summary.load_bootstrap_matrix(self.file_path, Niter = Niter)
+            self.assertEqual(list(dataset), [row[0] for row in self.rows])
+            self.assertEqual(list(site), [row[1] for row in self.rows])
+            np.testing.assert_array_equal(orig, [row[2] for row in self.rows])
+            num_col = 4 if Niter is None else Niter
+            self.assertEqual(samples.shape, (len(self.rows), num_col))
+            for i, row in enumerate(self.rows):
+                row_samples = row[3][:num_col]
+                np.testing.assert_array_equal(samples[i], row_samples + [np.nan] * (num_col - len(row_samples)))
+
+    def test_malformed_value(self):
+        with open(self.file_path, 'a') as f:
+            f.write('Luquillo,1,0.5,0.1,0.x3,0.7\n')
+        self.assertRaises(ValueError, boot_summary.load_bootstrap_matrix, self.file_path)
+
+if __name__ == '__main__':
+    unittest.main()
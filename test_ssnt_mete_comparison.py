@@ -0,0 +1,241 @@
+"""Regression tests of the vectorized computations in ssnt_mete_comparison against the scalar versions they replace.
+
+Run with python -m unittest discover (or pytest) from the directory of the module.
+
+"""
+from __future__ import division
+import unittest
+import numpy as np
+from numpy.lib.recfunctions import append_fields
+from scipy import integrate, optimize, special, stats
+import ssnt_mete_comparison as smc
+
+def ssnt_isd_pdf_scalar(alpha, par, x):
+    """pdf of ssnt_isd_bounded for a single value, as originally written."""
+    if x < 1: return 0
+    else: return par * alpha * np.exp(-par * (x ** alpha - 1)) * (x ** (alpha - 1))
+
+def clean_data_agsne_loop(raw_data_site, cutoff_genera = 4, cutoff_sp = 9, max_removal = 0.1):
+    """clean_data_agsne() as originally written, with one pass over the individuals."""
+    counter = 0
+    genus_list = []
+    row_to_remove = []
+    for i, row in enumerate(raw_data_site):
+        sp_split = row['sp'].split(' ')
+        genus = sp_split[0]
+        if len(sp_split) > 1 and genus[0].isupper() and genus[1].islower() and (not any(char.isdigit() for char in genus)):
+            genus_list.append(genus)
+        else: 
+            row_to_remove.append(i)
+            counter += 1
+    if counter / len(raw_data_site) <= max_removal:
+        raw_data_site = np.delete(raw_data_site, np.array(row_to_remove, dtype = int), axis = 0)
+        gen_col = np.array(genus_list)
+        out = append_fields(raw_data_site, 'genus', gen_col, usemask = False)
+        if len(np.unique(out['sp'])) > cutoff_sp and len(np.unique(out['genus'])) > cutoff_genera: 
+            return out
+        else: return None
+    else: return None
+
+def make_site(N = 600, S = 30, G = 12, seed = 0):
+    """Synthetic cleaned site (see clean_data_agsne()) with N individuals of S species in G genera."""
+    prng = np.random.RandomState(seed)
+    sp_names = np.array(['Genus' + chr(ord('a') + i % G) + ' sp' + str(i) for i in xrange(S)])
+    site = np.zeros(N, dtype = [('site', 'S15'), ('sp', 'S40'), ('dbh', 'f8'), ('genus', 'S20')])
+    site['site'] = '1'
+    site['sp'] = sp_names[np.minimum(prng.geometric(0.1, size = N) - 1, S - 1)]
+    site['dbh'] = np.round(prng.lognormal(2, 0.5, size = N), 1) + 1
+    site['genus'] = [sp.split(' ')[0] for sp in site['sp']]
+    return site
+
+class theta_epsilon_scalar():
+    """Stand-in for mete_distributions.theta_epsilon with the same attributes, 
+    
+    and a pdf, cdf and rvs that work on one value at a time from the pdf (Eqn 7.25).
+    
+    """
+    def __init__(self, S0, N0, E0):
+        self.beta, self.lambda2, self.E0 = 0.01, 0.002, E0
+        self.lambda1 = self.beta - self.lambda2
+        self.sigma = self.beta + (E0 - 1) * self.lambda2
+
+    def pdf(self, x, n):
+        if x < 1 or x > self.E0: return 0
+        norm = np.exp(-self.beta * n) - np.exp(-self.sigma * n)
+        return self.lambda2 * n * np.exp(-(self.lambda1 + self.lambda2 * x) * n) / norm
+
+    def logpdf(self, x, n):
+        return np.log(self.pdf(x, n))
+
+    def cdf(self, x, n):
+        norm = np.exp(-self.beta * n) - np.exp(-self.sigma * n)
+        return (np.exp(-self.beta * n) - np.exp(-(self.lambda1 + self.lambda2 * x) * n)) / norm
+
+    def rvs(self, n, size):
+        return np.array([optimize.brentq(lambda x: self.cdf(x, n) - q, 1, self.E0) for q in np.random.uniform(size = size)])
+
+class test_clean_data_agsne(unittest.TestCase):
+    def test_match_loop(self):
+        bad_names = ['unknown', 'Gen3 x', 'GENUS y', 'Unid', 'Myrc1 a', 'genusa sp1']
+        for frac_bad, S, G in [(0, 30, 12), (0.05, 30, 12), (0.1, 30, 12), (0.2, 30, 12), (0.05, 9, 5), (0.05, 30, 4)]:
+            raw_data_site = make_site(S = S, G = G)[['site', 'sp', 'dbh']]
+            raw_data_site = np.array(raw_data_site, dtype = [('site', 'S15'), ('sp', 'S40'), ('dbh', 'f8')])
+            prng = np.random.RandomState(1)
+            is_bad = np.arange(len(raw_data_site)) < int(frac_bad * len(raw_data_site))
+            raw_data_site['sp'][prng.permutation(is_bad)] = prng.choice(bad_names, np.sum(is_bad))
+            out = smc.clean_data_agsne(raw_data_site)
+            out_loop = clean_data_agsne_loop(raw_data_site)
+            if out_loop is None: 
+                self.assertIsNone(out)
+                continue
+            self.assertEqual(out.dtype.names, out_loop.dtype.names)
+            for name in out_loop.dtype.names:
+                np.testing.assert_array_equal(out[name], out_loop[name])
+
+class test_get_sad_bootstrap_stats(unittest.TestCase):
+    def test_match_iteration_loop(self):
+        dist, S, Niter = stats.logser(0.995), 60, 50
+        np.random.seed(3)
+        pred = np.sort(dist.rvs(S)).astype(float)
+        np.random.seed(5)
+        rsquare, ks = smc.get_sad_bootstrap_stats(dist, pred, Niter)
+        np.random.seed(5)
+        rsquare_loop, ks_loop = [], []
+        for i in range(Niter):
+            obs_boot = np.array(sorted(dist.rvs(S)))
+            cdf_boot = np.array([dist.cdf(x) for x in obs_boot])
+            emp_cdf_boot = smc.mtools.get_emp_cdf(obs_boot)
+            rsquare_loop.append(smc.mtools.obs_pred_rsquare(np.log10(obs_boot), np.log10(pred)))
+            ks_loop.append(max(abs(emp_cdf_boot - np.array(cdf_boot))))
+        np.testing.assert_allclose(rsquare, rsquare_loop, rtol = 1e-12)
+        np.testing.assert_allclose(ks, ks_loop, rtol = 1e-12)
+
+class test_get_lik_sp_abd_dbh_community(unittest.TestCase):
+    def setUp(self):
+        self.par_cache_dir, smc.par_cache_dir = smc.par_cache_dir, None
+        self.theta_epsilon, smc.mete_distributions.theta_epsilon = \
+            getattr(smc.mete_distributions, 'theta_epsilon', None), theta_epsilon_scalar
+
+    def tearDown(self):
+        smc.par_cache_dir = self.par_cache_dir
+        smc.mete_distributions.theta_epsilon = self.theta_epsilon
+
+    def test_lik_match_species_loop(self):
+        site = make_site()
+        G, S, N, E = smc.get_GSNE(site)
+        d_list = site['dbh'] / min(site['dbh'])
+        p_asne = np.exp(-smc.get_beta_cached(S, N))
+        p_ssnt = np.exp(-smc.get_beta_cached(S, N, version = 'untruncated'))
+        lik_loop = {'asne': 0, 'ssnt_0': 0, 'ssnt_1': 0}
+        for sp in np.unique(site['sp']):
+            sp_dbh = d_list[site['sp'] == sp]
+            lik_loop['asne'] += smc.lik_sp_abd_dbh_asne([G, S, N, E], p_asne, len(sp_dbh), sp_dbh)
+            for model in ['ssnt_0', 'ssnt_1']:
+                lik_loop[model] += smc.lik_sp_abd_dbh_ssnt([G, S, N, E], p_ssnt, model, len(sp_dbh), sp_dbh, d_list)
+        lik = smc.get_lik_sp_abd_dbh_community(site, models = ('asne', 'ssnt_0', 'ssnt_1'))
+        for model in lik_loop:
+            np.testing.assert_allclose(lik[model], lik_loop[model], rtol = 1e-10)
+
+class test_draw_sdr_sample(unittest.TestCase):
+    def test_asne_match_rvs(self):
+        dist = theta_epsilon_scalar(30, 600, 5000)
+        n_sp, m_sp = np.array([1, 4, 15]), np.array([1, 2, 2])
+        offsets = np.concatenate(([0], np.cumsum(n_sp)[:-1]))
+        num_iter = 2000
+        np.random.seed(1)
+        sample = smc.draw_sdr_sample(dist, 'asne', n_sp, m_sp, num_iter)
+        self.assertEqual(sample.shape, (num_iter, np.sum(n_sp)))
+        np.random.seed(2)
+        for n, offset in zip(n_sp, offsets):
+            sample_sp = sample[:, offset:(offset + n)]
+            self.assertTrue(np.all((sample_sp >= 1) & (sample_sp <= dist.E0)))
+            self.assertGreater(stats.ks_2samp(sample_sp.ravel(), dist.rvs(n, num_iter * n))[1], 0.001)
+            mean = integrate.quad(lambda x: x * dist.pdf(x, n), 1, dist.E0)[0]
+            var = integrate.quad(lambda x: (x - mean) ** 2 * dist.pdf(x, n), 1, dist.E0)[0]
+            self.assertLess(abs(np.mean(sample_sp) - mean), 4 * np.sqrt(var / sample_sp.size))
+
+class test_ssnt_isd_bounded(unittest.TestCase):
+    def setUp(self):
+        self.x = np.array([0.5, 1, 1.01, 1.3, 2, 7.5, 10, 55.5])
+        self.pars = [(1, 0.8), (2/3, 0.05), (1.7, 0.3), (0.1, 2)]
+
+    def test_pdf_logpdf(self):
+        for alpha, par in self.pars:
+            isd = smc.ssnt_isd_bounded(alpha, par)
+            pdf_scalar = np.array([ssnt_isd_pdf_scalar(alpha, par, x) for x in self.x])
+            np.testing.assert_allclose(isd.pdf(self.x), pdf_scalar, rtol = 1e-12)
+            with np.errstate(divide = 'ignore'):
+                np.testing.assert_allclose(isd.logpdf(self.x), np.log(pdf_scalar), rtol = 1e-12)
+            self.assertEqual(isd.pdf(self.x[3]), pdf_scalar[3])
+
+    def test_cdf_ppf(self):
+        for alpha, par in self.pars:
+            isd = smc.ssnt_isd_bounded(alpha, par)
+            cdf_scalar = np.array([0 if x < 1 else 1 - np.exp(-par * (x ** alpha - 1)) for x in self.x])
+            np.testing.assert_allclose(isd.cdf(self.x), cdf_scalar, rtol = 1e-10, atol = 1e-15)
+            q = np.array([1e-6, 0.1, 0.5, 0.9, 0.999])
+            np.testing.assert_allclose(isd.cdf(isd.ppf(q)), q, rtol = 1e-8)
+
+    def test_moment(self):
+        for alpha, par in self.pars[:3]:
+            isd = smc.ssnt_isd_bounded(alpha, par)
+            for k, moment in [(1, isd.expected()), (2, isd.expected_square())]:
+                moment_quad = integrate.quad(lambda x: x ** k * ssnt_isd_pdf_scalar(alpha, par, x), 1, np.inf)[0]
+                np.testing.assert_allclose(moment, moment_quad, rtol = 1e-7)
+
+    def test_moment_heavy_tail(self):
+        # With alpha = 1 / m, D^k = (1 + Y)^(m * k) with Y exponential, whose moments are j! / par^j
+        alpha, par = 0.1, 2
+        isd = smc.ssnt_isd_bounded(alpha, par)
+        for k, moment in [(1, isd.expected()), (2, isd.expected_square())]:
+            moment_exact = sum([special.comb(10 * k, j, exact = True) * special.factorial(j, exact = True) / par ** j 
+                                for j in xrange(10 * k + 1)])
+            np.testing.assert_allclose(moment, moment_exact, rtol = 1e-10)
+
+class truncated_pareto_scalar():
+    """Pareto distribution truncated to [1, upper], with a pdf and ppf that take scalars only, like psi_epsilon_approx."""
+    def __init__(self, b, upper):
+        self.b = b
+        self.upper = upper
+        self.norm = 1 - upper ** (-b)
+
+    def pdf(self, x):
+        if x < 1 or x > self.upper: return 0
+        else: return self.b * x ** (-self.b - 1) / self.norm
+
+    def ppf(self, q):
+        return (1 - q * self.norm) ** (-1 / self.b)
+
+class test_get_isd_quantiles(unittest.TestCase):
+    def test_quantiles_match_ppf(self):
+        N = 2000
+        q = (np.arange(N) + 0.5) / N
+        for b, upper in [(1.5, 1e4), (0.5, 250), (3, 1e6)]:
+            dist = truncated_pareto_scalar(b, upper)
+            quan_exact = smc.get_isd_quantiles(dist, q, 1, upper, exact = True)
+            np.testing.assert_allclose(quan_exact, [dist.ppf(x) for x in q], rtol = 1e-15)
+            np.testing.assert_allclose(smc.get_isd_quantiles(dist, q, 1, upper), quan_exact, rtol = 1e-5)
+
+class test_get_ssnt_isd_loglik_alphas(unittest.TestCase):
+    def setUp(self):
+        # Diameters recorded with limited precision, so that many of them are tied
+        dbh = np.round(np.random.RandomState(7).lognormal(2.5, 0.6, size = 3000), 1)
+        self.dbh_scaled = dbh / min(dbh)
+        self.alpha_list = [1e-3, 0.05, 0.3, 2/3, 1, 1.5, 2.5]
+
+    def test_loglik_match_logpdf(self):
+        loglik, par = smc.get_ssnt_isd_loglik_alphas(self.dbh_scaled, self.alpha_list)
+        for i, alpha in enumerate(self.alpha_list):
+            par_scalar = len(self.dbh_scaled) / (sum(self.dbh_scaled ** alpha) - len(self.dbh_scaled))
+            loglik_scalar = sum(smc.ssnt_isd_bounded(alpha, par_scalar).logpdf(self.dbh_scaled))
+            np.testing.assert_allclose(par[i], par_scalar, rtol = 1e-9)
+            np.testing.assert_allclose(loglik[i], loglik_scalar, rtol = 1e-12)
+
+    def test_chunks(self):
+        loglik, par = smc.get_ssnt_isd_loglik_alphas(self.dbh_scaled, self.alpha_list)
+        loglik_chunk, par_chunk = smc.get_ssnt_isd_loglik_alphas(self.dbh_scaled, self.alpha_list, max_values = 10)
+        np.testing.assert_allclose(loglik_chunk, loglik, rtol = 1e-14)
+        np.testing.assert_allclose(par_chunk, par, rtol = 1e-14)
+
+if __name__ == '__main__':
+    unittest.main()